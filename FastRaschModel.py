@@ -1,48 +1,232 @@
 import warnings
 import numpy as np
 import pandas as pd
-from numba import njit
+from numba import njit, prange
 from scipy.optimize import minimize
 
 warnings.filterwarnings('ignore')
 
 
+# Kernels are compiled with cache=True so a restarted process loads machine code
+# from __pycache__ (or NUMBA_CACHE_DIR) instead of recompiling. Parallel kernels
+# use NUMBA_NUM_THREADS threads; fastmath is only enabled where every input is
+# bounded (abilities and difficulties live in [-5, 5]).
+
+
+@njit(cache=True, inline='always')
+def _probability(diff):
+    if diff > 20:
+        return 1.0
+    if diff < -20:
+        return 0.0
+    return 1.0 / (1.0 + np.exp(-diff))
+
+
+@njit(cache=True)
+def _elementary_symmetric_functions(eps):
+    gamma = np.zeros(eps.shape[0] + 1)
+    gamma[0] = 1.0
+    for j in range(eps.shape[0]):
+        for r in range(j + 1, 0, -1):
+            gamma[r] += eps[j] * gamma[r - 1]
+    return gamma
+
+
 class FastRaschModel:
     def __init__(self):
         self.item_difficulty = None
         self.person_ability = None
+        self.ability_table = None
 
     @staticmethod
-    @njit
-    def _calculate_log_likelihood(X, beta, theta):
-        log_lik = 0.0
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _log_likelihood_and_gradient(X, beta, theta):
+        # Negative log-likelihood and its analytic gradient:
+        # d(-logL)/d(theta_i) = -sum_j (x_ij - p_ij), d(-logL)/d(beta_j) = sum_i (x_ij - p_ij)
         n_persons, n_items = X.shape
-        for i in range(n_persons):
+        log_lik = 0.0
+        grad_beta = np.zeros(n_items)
+        grad_theta = np.zeros(n_persons)
+        # Persons in parallel: each thread owns grad_theta[i], log_lik is a reduction
+        for i in prange(n_persons):
+            row_lik = 0.0
+            row_residual = 0.0
             for j in range(n_items):
                 diff = theta[i] - beta[j]
-                if diff > 20:
-                    p = 1.0
-                elif diff < -20:
-                    p = 0.0
-                else:
-                    p = 1.0 / (1.0 + np.exp(-diff))
-
+                p = _probability(diff)
                 if X[i, j] == 1:
-                    log_lik += np.log(p)
+                    row_lik -= np.log1p(np.exp(-diff))
+                    row_residual += 1.0 - p
                 else:
-                    log_lik += np.log(1.0 - p)
-        return -log_lik
+                    row_lik -= np.log1p(np.exp(diff))
+                    row_residual -= p
+            grad_theta[i] = -row_residual
+            log_lik += row_lik
+        # Items in a second parallel pass, so no two threads add into the same grad_beta[j]
+        for j in prange(n_items):
+            residual = 0.0
+            for i in range(n_persons):
+                residual += X[i, j] - _probability(theta[i] - beta[j])
+            grad_beta[j] = residual
+        return -log_lik, grad_beta, grad_theta
 
-    def fit(self, X, max_iter=50, tol=1e-3, batch_size=2000):
+    @staticmethod
+    @njit(cache=True)
+    def _collapsed_log_likelihood_and_gradient(item_totals, scores, counts, beta, theta):
+        # Joint likelihood written in terms of its sufficient statistics: item totals
+        # and the raw-score frequency table, with one ability per score group.
+        n_groups = scores.shape[0]
+        n_items = beta.shape[0]
+        log_lik = 0.0
+        grad_beta = item_totals.astype(np.float64)
+        grad_theta = np.zeros(n_groups)
+        for j in range(n_items):
+            log_lik -= item_totals[j] * beta[j]
+        for g in range(n_groups):
+            expected = 0.0
+            for j in range(n_items):
+                diff = theta[g] - beta[j]
+                p = _probability(diff)
+                log_lik -= counts[g] * np.log1p(np.exp(diff))
+                expected += p
+                grad_beta[j] -= counts[g] * p
+            log_lik += counts[g] * scores[g] * theta[g]
+            grad_theta[g] = -counts[g] * (scores[g] - expected)
+        return -log_lik, grad_beta, grad_theta
+
+    @staticmethod
+    @njit(cache=True, parallel=True)
+    def _conditional_log_likelihood_and_gradient(item_totals, score_counts, beta):
+        # CML: P(x | r) = prod_j eps_j^x_j / gamma_r(eps) with eps_j = exp(-beta_j),
+        # so the likelihood only needs item totals and the raw-score counts.
+        # Difficulties are centered before exponentiating to keep gamma in range;
+        # gamma_r(eps) = gamma_r(centered eps) * exp(-r * mean(beta)).
+        n_items = beta.shape[0]
+        shift = beta.mean()
+        eps = np.exp(-(beta - shift))
+        gamma = _elementary_symmetric_functions(eps)
+
+        log_lik = 0.0
+        grad_beta = item_totals.astype(np.float64)
+        for j in range(n_items):
+            log_lik -= item_totals[j] * beta[j]
+        for r in range(1, n_items + 1):
+            log_lik -= score_counts[r] * (np.log(gamma[r]) - r * shift)
+
+        # One item per thread; each builds its own leave-one-out gamma
+        for j in prange(n_items):
+            # gamma_{r-1} over every item except j
+            eps_without = np.empty(n_items - 1)
+            eps_without[:j] = eps[:j]
+            eps_without[j:] = eps[j + 1:]
+            gamma_without = _elementary_symmetric_functions(eps_without)
+            for r in range(1, n_items + 1):
+                grad_beta[j] -= score_counts[r] * eps[j] * gamma_without[r - 1] / gamma[r]
+        return -log_lik, grad_beta
+
+    @staticmethod
+    def _ability_table(beta, max_iter=100, tol=1e-8):
+        # Maximum likelihood ability for every raw score 0..n_items given fixed
+        # item difficulties; extreme scores are pinned to the parameter bounds.
+        n_items = len(beta)
+        scores = np.arange(n_items + 1, dtype=np.float64)
+        theta = np.clip(np.log((scores + 0.5) / (n_items - scores + 0.5)) + beta.mean(), -5, 5)
+        for _ in range(max_iter):
+            p = 1.0 / (1.0 + np.exp(-(theta[:, None] - beta[None, :])))
+            step = (p.sum(axis=1) - scores) / (p * (1.0 - p)).sum(axis=1)
+            theta = np.clip(theta - step, -5, 5)
+            if np.abs(step[1:-1]).max(initial=0.0) < tol:
+                break
+        theta[0] = -5
+        theta[-1] = 5
+        return theta
+
+    def estimate_abilities(self, X):
+        # Score persons against the current (fixed) item difficulties without refitting
+        if self.item_difficulty is None:
+            raise ValueError("Item difficulties have not been estimated yet")
         X_np = X.values if isinstance(X, pd.DataFrame) else X
+        X_np = np.ascontiguousarray(X_np, dtype=np.int8)
+        self.item_difficulty = np.asarray(self.item_difficulty, dtype=np.float64)
+        if X_np.shape[1] != len(self.item_difficulty):
+            raise ValueError("Response matrix does not match the number of calibrated items")
+
+        self.ability_table = self._ability_table(self.item_difficulty)
+        self.person_ability = self.ability_table[X_np.sum(axis=1, dtype=np.int64)]
+        return self.person_ability
+
+    def _fit_conditional(self, X_np, max_iter, tol, initial_beta):
+        n_items = X_np.shape[1]
+        item_totals = X_np.sum(axis=0, dtype=np.int64)
+        raw_scores = X_np.sum(axis=1, dtype=np.int64)
+        score_counts = np.bincount(raw_scores, minlength=n_items + 1)
+
+        def conditional_neg_log_lik(params):
+            return self._conditional_log_likelihood_and_gradient(item_totals, score_counts, params)
+
+        result = minimize(conditional_neg_log_lik, initial_beta,
+                          method='L-BFGS-B',
+                          jac=True,
+                          bounds=[(-5, 5)] * n_items,
+                          options={'maxiter': max_iter, 'gtol': tol})
+
+        self.item_difficulty = result.x - result.x.mean()
+        self.ability_table = self._ability_table(self.item_difficulty)
+        self.person_ability = self.ability_table[raw_scores]
+
+    def _fit_collapsed(self, X_np, max_iter, tol, initial_beta):
+        n_items = X_np.shape[1]
+        item_totals = X_np.sum(axis=0, dtype=np.int64)
+        raw_scores = X_np.sum(axis=1, dtype=np.int64)
+        scores, group_idx, counts = np.unique(raw_scores, return_inverse=True, return_counts=True)
+        n_groups = len(scores)
+
+        initial_guess = np.concatenate([initial_beta, np.zeros(n_groups)])
+        bounds = [(-5, 5)] * (n_items + n_groups)
+
+        def collapsed_neg_log_lik(params):
+            beta = params[:n_items]
+            theta = params[n_items:]
+            nll, grad_beta, grad_theta = self._collapsed_log_likelihood_and_gradient(
+                item_totals, scores, counts, beta, theta)
+            return nll, np.concatenate([grad_beta, grad_theta])
+
+        result = minimize(collapsed_neg_log_lik, initial_guess,
+                          method='L-BFGS-B',
+                          jac=True,
+                          bounds=bounds,
+                          options={'maxiter': max_iter, 'gtol': tol})
+
+        self.item_difficulty = result.x[:n_items]
+        self.person_ability = result.x[n_items:][group_idx.ravel()]
+
+    def fit(self, X, max_iter=50, tol=1e-3, batch_size=2000, method='joint', initial_beta=None):
+        X_np = X.values if isinstance(X, pd.DataFrame) else X
+        X_np = np.ascontiguousarray(X_np, dtype=np.int8)
         n_persons, n_items = X_np.shape
 
+        # Warm start from previously calibrated item difficulties when available
+        if initial_beta is None:
+            initial_beta = np.zeros(n_items)
+        else:
+            initial_beta = np.clip(np.asarray(initial_beta, dtype=np.float64), -5, 5)
+            if initial_beta.shape != (n_items,):
+                raise ValueError("initial_beta does not match the number of items")
+
+        if method == 'collapsed':
+            self._fit_collapsed(X_np, max_iter, tol, initial_beta)
+            return
+        if method == 'cml':
+            self._fit_conditional(X_np, max_iter, tol, initial_beta)
+            return
+        if method != 'joint':
+            raise ValueError(f"Unknown estimation method: {method}")
+
         # if np.all((X_np == X_np[0]).all(axis=1)):
         #     self.item_difficulty = 0
         #     self.person_ability = 0
         #     return
 
-        initial_beta = np.zeros(n_items)
         initial_theta = np.zeros(n_persons)
         initial_guess = np.concatenate([initial_beta, initial_theta])
 
@@ -57,10 +241,16 @@ class FastRaschModel:
                     beta = params[:n_items]
                     theta = params[n_items:]
                     theta_batch = theta[batch_idx]
-                    return self._calculate_log_likelihood(X_batch, beta, theta_batch)
+                    nll, grad_beta, grad_theta_batch = self._log_likelihood_and_gradient(
+                        X_batch, beta, theta_batch)
+                    grad = np.zeros_like(params)
+                    grad[:n_items] = grad_beta
+                    grad[n_items:][batch_idx] = grad_theta_batch
+                    return nll, grad
 
                 result = minimize(batch_neg_log_lik, initial_guess,
                                   method='L-BFGS-B',
+                                  jac=True,
                                   bounds=bounds,
                                   options={'maxiter': 10, 'gtol': tol})
 
@@ -71,12 +261,27 @@ class FastRaschModel:
             def full_neg_log_lik(params):
                 beta = params[:n_items]
                 theta = params[n_items:]
-                return self._calculate_log_likelihood(X_np, beta, theta)
+                nll, grad_beta, grad_theta = self._log_likelihood_and_gradient(X_np, beta, theta)
+                return nll, np.concatenate([grad_beta, grad_theta])
 
             result = minimize(full_neg_log_lik, initial_guess,
                               method='L-BFGS-B',
+                              jac=True,
                               bounds=bounds,
                               options={'maxiter': max_iter, 'gtol': tol})
 
         self.item_difficulty = result.x[:n_items]
         self.person_ability = result.x[n_items:]
+
+
+def warm_up():
+    """
+    Compile every kernel, or load it from the on-disk cache, with the argument
+    types fit() and estimate_abilities() use, so the first real request does
+    not pay for it.
+    """
+    X = np.ascontiguousarray([[1, 0, 1], [0, 1, 1], [1, 1, 0], [0, 0, 1]], dtype=np.int8)
+    model = FastRaschModel()
+    for method in ('cml', 'collapsed', 'joint'):
+        model.fit(X, max_iter=2, method=method)
+    model.estimate_abilities(X)
@@ -0,0 +1,193 @@
+import logging
+import time
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.stats import zscore
+
+from FastRaschModel import FastRaschModel
+from app.grading import full_name, grade_responses
+from app.rasch_output import RaschOutput
+
+logger = logging.getLogger(__name__)
+
+# Refit item difficulties once the cohort has grown by more than this fraction
+# since the stored calibration; smaller increments are scored against it as is.
+RASCH_REFIT_GROWTH = 0.1
+
+
+def build_results_frame(
+        records: Sequence[Dict[str, Any]],
+        correct_answers,
+        correct_36_45,
+        test_id: str
+) -> pd.DataFrame:
+    """
+    Build the 1/0 results table.
+    Pure CPU work, safe to run in a worker process.
+    """
+    graded = grade_responses(records, correct_answers, correct_36_45, test_id)
+    df = pd.DataFrame(graded.responses, columns=graded.columns)
+
+    df.insert(0, 'F.I.O', [full_name(record) for record in records])
+    df.insert(0, '№', range(1, len(records) + 1))
+    return df
+
+
+def prepare_rasch_frame(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Normalize column names and extract the 0/1 response matrix."""
+    logger.debug(f"Data loaded successfully with {len(df)} rows")
+    logger.debug(f"Faylda mavjud ustunlar: {df.columns.tolist()}")
+
+    # Agar ustun nomlari boshqacha bo'lsa, ularni moslashtiring
+    required_columns = ['№', 'F.I.O.', 'Duris']
+    available_columns = df.columns.tolist()
+
+    # Ustun nomlarini tekshirish va moslashtirish
+    if not all(col in available_columns for col in required_columns):
+        # Agar standart nomlar topilmasa, birinchi 3 ustundan foydalaning
+        if len(df.columns) >= 3:
+            df.columns = ['№', 'F.I.O.', 'Duris'] + list(df.columns[3:])
+            logger.debug("Ustun nomlari avtomatik moslashtirildi")
+        else:
+            raise ValueError("Faylda kamida 3 ta ustun bo'lishi kerak")
+
+    # Column handling
+    if len(df.columns) < 3:
+        raise ValueError("File must have at least 3 columns")
+
+    # Auto-detect response columns (assuming they start from column 3)
+    response_cols = df.columns[3:]
+    logger.debug(f"Detected {len(response_cols)} response columns")
+
+    # Convert responses to binary (1 for correct, 0 for incorrect)
+    response_data = (df[response_cols] == 1).astype(np.int8)
+    return df, response_data
+
+
+def fit_rasch_model(
+        response_data: pd.DataFrame,
+        item_difficulty: Optional[List[float]] = None,
+        n_persons: Optional[int] = None
+) -> Tuple[FastRaschModel, bool]:
+    """
+    Estimate person abilities, reusing a stored item calibration when the cohort
+    has barely changed since it was estimated. Returns (model, refitted).
+    """
+    model = FastRaschModel()
+    current_persons, n_items = response_data.shape
+    if item_difficulty is not None and len(item_difficulty) != n_items:
+        item_difficulty = None
+
+    if item_difficulty is not None and current_persons - n_persons <= RASCH_REFIT_GROWTH * n_persons:
+        logger.debug("Scoring against stored item calibration...")
+        model.item_difficulty = item_difficulty
+        model.estimate_abilities(response_data)
+        return model, False
+
+    logger.debug("Fitting Rasch model...")
+    model.fit(response_data, method='cml', initial_beta=item_difficulty)
+    return model, True
+
+
+def score_rasch_results(df: pd.DataFrame, person_ability, n_items: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Turn abilities into scaled scores and grade bands. The tie-breaking jitter
+    is seeded, so the same submission set always gets the same scores.
+    """
+    logger.debug("Calculating scores...")
+    df['Theta'] = person_ability
+    df['Ball'] = 50 + 10 * zscore(df['Theta'])
+    df['Ball'] = np.round(df['Ball'], 2)
+
+    rng = np.random.default_rng(seed)
+    df['Ball'] = df['Ball'] + rng.uniform(-0.05, 0.05, size=len(df['Ball']))
+    df['Ball'] = df['Ball'].round(decimals=2)
+
+    # Determine subject type based on max possible score
+    max_possible = n_items
+    subject_type = "1-fan" if max_possible >= 45 else "2-fan"
+
+    # Calculate proportional scores
+    theta_min = df['Theta'].min()
+    theta_range = df['Theta'].max() - theta_min
+    if theta_range > 0:
+        df['Prop_Score'] = ((df['Theta'] - theta_min) / theta_range) * (max_possible - 65) + 65
+    else:
+        df['Prop_Score'] = 65  # Handle case where all abilities are equal
+
+    # Assign grades
+    bins = [0, 46, 50, 55, 60, 65, 70, 93]
+    labels = ['NC', 'C', 'C+', 'B', 'B+', 'A', 'A+']
+    df['Daraja'] = pd.cut(df['Ball'], bins=bins, labels=labels, right=False)
+    return df
+
+
+def render_rasch_xlsx(df: pd.DataFrame) -> bytes:
+    """Render the ranked Rasch results as an .xlsx workbook."""
+    result_cols = ['№', 'F.I.O.', 'Ball', 'Daraja']
+    if '№' not in df.columns:
+        result_cols = [col for col in result_cols if col != '№']
+
+    logger.debug("Saving results...")
+    df = df.sort_values(by='Ball', ascending=False)
+    df['№'] = range(1, len(df) + 1)
+
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df[result_cols].to_excel(writer, index=False, sheet_name='Natijalar')
+    return output.getvalue()
+
+
+def run_rasch_analysis(
+        df: pd.DataFrame,
+        item_difficulty: Optional[List[float]] = None,
+        n_persons: Optional[int] = None,
+        seed: int = 0
+) -> RaschOutput:
+    """Full Rasch pipeline on a graded results frame."""
+    timings = {}
+    start = time.perf_counter()
+    df, response_data = prepare_rasch_frame(df)
+    timings["rasch_prepare"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model, refitted = fit_rasch_model(response_data, item_difficulty, n_persons)
+    timings["rasch_fit"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df = score_rasch_results(df, model.person_ability, response_data.shape[1], seed)
+    timings["rasch_score"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    content = render_rasch_xlsx(df)
+    timings["rasch_render"] = time.perf_counter() - start
+
+    new_calibration = [float(b) for b in model.item_difficulty] if refitted else None
+    # Plain records, so the web process can cache them without importing pandas
+    scores = df[['F.I.O.', 'Theta', 'Ball', 'Daraja']].astype({'Daraja': str}).to_dict('records')
+    return RaschOutput(content, new_calibration, len(response_data), scores, timings)
+
+
+def run_rasch_from_records(
+        records: Sequence[Dict[str, Any]],
+        correct_answers,
+        correct_36_45,
+        test_id: str,
+        item_difficulty: Optional[List[float]] = None,
+        n_persons: Optional[int] = None,
+        seed: int = 0
+) -> RaschOutput:
+    """
+    Grade submission rows and run the Rasch pipeline in one call, so the
+    results frame is built and used in the same worker process.
+    """
+    start = time.perf_counter()
+    df = build_results_frame(records, correct_answers, correct_36_45, test_id)
+    grading_seconds = time.perf_counter() - start
+
+    output = run_rasch_analysis(df, item_difficulty, n_persons, seed)
+    output.timings["grading"] = grading_seconds
+    return output
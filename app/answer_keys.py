@@ -0,0 +1,131 @@
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import engine
+from app.lru import LRUCache
+from app.utils import answer_key_hash, invalidate_reference_expressions, mcq_key
+
+logger = logging.getLogger(__name__)
+
+# Seconds a cached answer key is trusted without an invalidation
+ANSWER_KEY_TTL = float(os.getenv("ANSWER_KEY_TTL", "60"))
+# Answer keys kept in memory, most recently used first
+ANSWER_KEY_CACHE_SIZE = int(os.getenv("ANSWER_KEY_CACHE_SIZE", "1024"))
+# How invalidations reach other workers: 'local' (this process only) or 'postgres' (LISTEN/NOTIFY)
+ANSWER_KEY_CHANNEL = os.getenv("ANSWER_KEY_CHANNEL", "local")
+NOTIFY_CHANNEL = "answer_key_invalidation"
+
+
+class AnswerKey(NamedTuple):
+    """A test's answer key decoded once and ready for grading."""
+    test_id: str
+    status: str
+    max_grade: int
+    answers_1_35: Tuple[str, ...]
+    answers_36_45: Dict[str, Any]
+    key_hash: str
+
+
+def to_answer_key(test) -> AnswerKey:
+    return AnswerKey(
+        test_id=test.test_id,
+        status=test.status,
+        max_grade=test.max_grade,
+        answers_1_35=mcq_key(test.answers_1_35),
+        answers_36_45=test.answers_36_45 or {},
+        key_hash=answer_key_hash(test.answers_1_35, test.answers_36_45),
+    )
+
+
+class AnswerKeyCache(LRUCache):
+    """TTL and LRU cache of answer keys by test_id, cleared explicitly on every change."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        super().__init__(maxsize if ttl > 0 else 0)
+        self.ttl = ttl
+
+    def get(self, test_id: str) -> Optional[AnswerKey]:
+        entry = super().get(test_id, valid=lambda entry: entry[0] >= time.monotonic())
+        return entry[1] if entry is not None else None
+
+    def put(self, key: AnswerKey):
+        super().put(key.test_id, (time.monotonic() + self.ttl, key))
+
+    def invalidate(self, test_id: str):
+        self.pop(test_id)
+
+
+class LocalInvalidationChannel:
+    """
+    In-process stand-in for the cross-worker channel: delivers invalidations to
+    subscribers of this process only. Enough for a single worker and for tests.
+    """
+
+    def __init__(self):
+        self._subscribers: List[Callable[[str], None]] = []
+
+    def subscribe(self, callback: Callable[[str], None]):
+        self._subscribers.append(callback)
+
+    def _deliver(self, test_id: str):
+        for callback in self._subscribers:
+            callback(test_id)
+
+    async def publish(self, db: AsyncSession, test_id: str):
+        self._deliver(test_id)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class PostgresInvalidationChannel(LocalInvalidationChannel):
+    """
+    Broadcasts invalidations to every worker with Postgres NOTIFY. Each worker
+    keeps one connection LISTENing; local subscribers are notified immediately.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._conn = None
+        self._listener = None
+
+    async def publish(self, db: AsyncSession, test_id: str):
+        self._deliver(test_id)
+        await db.execute(text("SELECT pg_notify(:channel, :test_id)"), {"channel": NOTIFY_CHANNEL, "test_id": test_id})
+        await db.commit()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._deliver(payload)
+
+    async def start(self):
+        self._conn = await engine.connect()
+        raw = await self._conn.get_raw_connection()
+        self._listener = raw.driver_connection
+        await self._listener.add_listener(NOTIFY_CHANNEL, self._on_notify)
+
+    async def stop(self):
+        if self._conn is None:
+            return
+        try:
+            await self._listener.remove_listener(NOTIFY_CHANNEL, self._on_notify)
+        finally:
+            await self._conn.close()
+            self._conn = None
+
+
+answer_key_cache = AnswerKeyCache(ANSWER_KEY_TTL, ANSWER_KEY_CACHE_SIZE)
+
+if ANSWER_KEY_CHANNEL == "postgres":
+    invalidation_channel = PostgresInvalidationChannel()
+else:
+    invalidation_channel = LocalInvalidationChannel()
+invalidation_channel.subscribe(answer_key_cache.invalidate)
+invalidation_channel.subscribe(invalidate_reference_expressions)
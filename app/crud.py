@@ -1,16 +1,22 @@
-import json
+import asyncio
 import logging
-from fileinput import filename
 from io import BytesIO
-from typing import Tuple
-import pandas as pd
+import os
+import zlib
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
 from fastapi import HTTPException
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncConnection
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.future import select
-from sqlalchemy.testing import db
-from app import models
-from sqlalchemy import text
-from app.utils import is_expression_equal
+from app import models, grading, metrics
+from app.exports import ResultsCsvWriter, ResultsXlsxWriter
+from sqlalchemy import and_, case, text, delete, update, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.database import AsyncSessionLocal
+from app.rasch_cache import RaschResult, rasch_result_cache
+from app.answer_keys import AnswerKey, answer_key_cache, invalidation_channel, to_answer_key
+from app.utils import SYMPY_WORKERS, build_reference_expressions, check_answers, grade_reference_batch, sheet_error
+from app.workers import run_analysis, run_cpu_bound
 
 
 async def get_test_by_id(db: AsyncSession, test_id: str):
@@ -19,92 +25,241 @@ async def get_test_by_id(db: AsyncSession, test_id: str):
     )
     return result.scalar_one_or_none()
 
-async def ensure_table_exists(test_id: str, db: AsyncSession):
-    table_name = f"test_{test_id.lower()}_answers"
-    check_sql = f"""
-    SELECT EXISTS (
-        SELECT FROM information_schema.tables 
-        WHERE table_name = '{table_name}'
-    )
+
+async def get_answer_key(db: AsyncSession, test_id: str) -> Optional[AnswerKey]:
     """
-    result = await db.execute(text(check_sql))
-    exists = result.scalar()
-
-    if not exists:
-        create_sql = f"""
-        CREATE TABLE {table_name} (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT UNIQUE,
-            firstname TEXT,
-            secondname TEXT,
-            thirdname TEXT,
-            region TEXT,
-            answers_1_35 TEXT,
-            answers_36_45 JSONB,
-            submission_time TIMESTAMP
-        )
-        """
-        await db.execute(text(create_sql))
-        await db.commit()
+    Answer key of a test for grading, served from the in-process cache.
+    Only a cache miss touches the database.
+    """
+    key = answer_key_cache.get(test_id)
+    if key is None:
+        test = await get_test_by_id(db, test_id)
+        if not test:
+            return None
+        key = to_answer_key(test)
+        answer_key_cache.put(key)
+    return key
 
-async def insert_user_answers(test_id: str, data: dict, db: AsyncSession):
-    table_name = f"test_{test_id.lower()}_answers"
 
-    insert_sql = f"""
-    INSERT INTO {table_name} (
-        telegram_id, firstname, secondname, thirdname,
-        region, answers_1_35, answers_36_45, submission_time
-    )
-    VALUES (
-        :telegram_id, :firstname, :secondname, :thirdname,
-        :region, :answers_1_35, :answers_36_45, :submission_time
-    )
-    """
+# Advisory lock key serializing the legacy table migration across workers
+LEGACY_MIGRATION_LOCK = zlib.crc32(b"migrate_legacy_submission_tables")
 
-    await db.execute(
-        text(insert_sql),
-        {
-            "telegram_id": data["telegram_id"],
-            "firstname": data["firstname"],
-            "secondname": data["secondname"],
-            "thirdname": data.get("thirdname"),
-            "region": data["region"],
-            "answers_1_35": data["answers_1_35"],
-            "answers_36_45": json.dumps(data["answers_36_45"]),
-            "submission_time": data["submission_time"]
-        }
-    )
-    await db.commit()
 
-async def get_user_telegram_id(test_id: str, telegram_id: int, db: AsyncSession):
-    table_name = f"test_{test_id.lower()}_answers"
-    check_sql_telegram_id = f"""
-        SELECT EXISTS (
-            SELECT 1 FROM {table_name} WHERE telegram_id = :telegram_id
+async def migrate_legacy_submission_tables(conn: AsyncConnection):
+    """
+    Copy rows from the old per-test test_<id>_answers tables into submissions and
+    rename each copied table to test_<id>_answers_migrated. Safe to run on
+    every startup: once nothing is left to migrate it is a single catalog query.
+    Must run inside a transaction; workers starting together take turns, and
+    each sees the tables renamed by the ones before it.
+    """
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": LEGACY_MIGRATION_LOCK})
+    result = await conn.execute(text(
+        "SELECT table_name FROM information_schema.tables WHERE table_name LIKE 'test\\_%\\_answers'"
+    ))
+    for table_name in result.scalars().all():
+        # Table names were built from test_id.lower(); recover the original spelling
+        lowered = table_name[len("test_"):-len("_answers")]
+        matches = await conn.execute(
+            select(models.Test.test_id).where(func.lower(models.Test.test_id) == lowered)
+        )
+        matches = matches.scalars().all()
+        test_id = matches[0] if len(matches) == 1 else lowered
+
+        # Tables created before grades were stored lack the grading columns
+        await conn.execute(text(f"""
+            ALTER TABLE {table_name}
+                ADD COLUMN IF NOT EXISTS correct_mask BIGINT,
+                ADD COLUMN IF NOT EXISTS total_score REAL,
+                ADD COLUMN IF NOT EXISTS key_hash TEXT
+        """))
+        copied = await conn.execute(
+            text(f"""
+                INSERT INTO submissions (
+                    test_id, telegram_id, firstname, secondname, thirdname,
+                    region, answers_1_35, answers_36_45, submission_time,
+                    correct_mask, total_score, key_hash
+                )
+                SELECT :test_id, telegram_id, firstname, secondname, thirdname,
+                       region, answers_1_35, answers_36_45, submission_time,
+                       correct_mask, total_score, key_hash
+                FROM {table_name}
+                WHERE telegram_id IS NOT NULL
+                ON CONFLICT (test_id, telegram_id) DO NOTHING
+            """),
+            {"test_id": test_id}
         )
-        """
-    result = await db.execute(text(check_sql_telegram_id), {"telegram_id": telegram_id})
-    exists = result.scalar()
+        await conn.execute(text(f"ALTER TABLE {table_name} RENAME TO {table_name}_migrated"))
+        logger.info(f"Migrated {copied.rowcount} submissions of test {test_id} from {table_name}")
+
+
+def submission_row(test_id: str, data: dict) -> dict:
+    """Column values of a submissions row built from a submit payload."""
+    return {
+        "test_id": test_id,
+        "telegram_id": data["telegram_id"],
+        "firstname": data["firstname"],
+        "secondname": data["secondname"],
+        "thirdname": data.get("thirdname"),
+        "region": data["region"],
+        "answers_1_35": data["answers_1_35"],
+        "answers_36_45": data["answers_36_45"],
+        "submission_time": data["submission_time"],
+        "correct_mask": data.get("correct_mask"),
+        "total_score": data.get("total_score"),
+        "key_hash": data.get("key_hash"),
+    }
+
+
+def insert_submissions_statement(rows: list):
+    """Multi-row INSERT that skips duplicates and returns the keys actually stored."""
+    return (
+        pg_insert(models.Submission)
+        .values(rows)
+        .on_conflict_do_nothing(constraint='uq_submissions_test_id_telegram_id')
+        .returning(models.Submission.id, models.Submission.test_id, models.Submission.telegram_id)
+    )
 
-    if exists:
+
+async def insert_user_answers(test_id: str, data: dict, db: AsyncSession):
+    """
+    Store a submission in a single round trip. The (test_id, telegram_id) unique
+    constraint rejects duplicates atomically; an empty RETURNING means the user
+    has already submitted this test.
+    """
+    statement = insert_submissions_statement([submission_row(test_id, data)])
+
+    with metrics.timed("db_write"):
+        if db.in_transaction():
+            # The session already holds a connection; taking a second one per
+            # request can exhaust the pool under load, so reuse it
+            result = await db.execute(statement)
+            submission_id = result.scalar()
+            await db.commit()
+        else:
+            # Autocommit: no BEGIN/COMMIT round trips around the single INSERT
+            async with db.bind.connect() as conn:
+                conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                result = await conn.execute(statement)
+                submission_id = result.scalar()
+
+    if submission_id is None:
         raise HTTPException(
             status_code=403,
             detail=f"User telegram id already exists."
         )
+    return submission_id
 
 
+# Free-response columns of answer-sheet checks graded at once across all
+# requests; more would only hold threadpool threads waiting for a guard worker
+_check_grading_slots = None
 
 
-async def get_all_tests(db: AsyncSession):
-    result = await db.execute(
-        select(models.Test)
-    )
-    return result.scalars().all()
+async def check_answer_sheets(
+        db: AsyncSession,
+        sheets: Sequence[Any]
+) -> List[Tuple[Optional[AnswerKey], Optional[Dict[str, Any]], Optional[str]]]:
+    """
+    Check many answer sheets, possibly for different tests. Each answer key is
+    loaded once, each distinct free-response answer is compared once per
+    (test, question, part), and as many columns are graded at once as the sympy
+    guard has workers.
+    Returns (answer key, check_answers result, error) per sheet in input order;
+    the result is None and the error says why for a sheet that names an unknown
+    test or question.
+    """
+    global _check_grading_slots
+    if _check_grading_slots is None:
+        _check_grading_slots = asyncio.Semaphore(SYMPY_WORKERS)
+
+    tests = {}
+    for test_id in dict.fromkeys(sheet.test_id for sheet in sheets):
+        tests[test_id] = await get_answer_key(db, test_id)
+
+    errors = [
+        sheet_error(sheet.answers_1_35, tests[sheet.test_id]) if tests[sheet.test_id] else "Test not found"
+        for sheet in sheets
+    ]
+
+    columns: Dict[Tuple[str, str, str], Dict[str, None]] = {}
+    for sheet, error in zip(sheets, errors):
+        if error:
+            continue
+        test = tests[sheet.test_id]
+        for q, parts in sheet.answers_36_45.items():
+            correct_parts = test.answers_36_45.get(q)
+            if not correct_parts:
+                continue
+            for part in ['a', 'b']:
+                if correct_parts.get(part) is not None:
+                    columns.setdefault((test.test_id, q, part), {})[getattr(parts, part)] = None
+
+    async def grade_column(test_id: str, q: str, part: str, answers: Dict[str, None]) -> Dict[str, Optional[bool]]:
+        async with _check_grading_slots:
+            return await run_in_threadpool(
+                grade_reference_batch, test_id, tests[test_id].answers_36_45, q, part, list(answers)
+            )
+
+    with metrics.timed("grading"):
+        column_verdicts = await asyncio.gather(*(
+            grade_column(test_id, q, part, answers) for (test_id, q, part), answers in columns.items()
+        ))
+    verdicts: Dict[str, Dict[Tuple[str, str], Dict[str, bool]]] = {test_id: {} for test_id in tests}
+    for (test_id, q, part), column in zip(columns, column_verdicts):
+        verdicts[test_id][(q, part)] = column
+
+    results = []
+    for sheet, error in zip(sheets, errors):
+        test = tests[sheet.test_id]
+        if error:
+            results.append((test, None, error))
+            continue
+        user_data = {"answers_1_35": sheet.answers_1_35, "answers_36_45": sheet.answers_36_45}
+        results.append((test, check_answers(user_data, test, verdicts[test.test_id]), None))
+    return results
+
+
+# Columns of a test listed without its answer keys
+TEST_SUMMARY_COLUMNS = (
+    models.Test.id,
+    models.Test.test_id,
+    models.Test.status,
+    models.Test.max_grade,
+    models.Test.created_at,
+)
+
+
+async def get_all_tests(
+        db: AsyncSession,
+        limit: int,
+        after_id: Optional[int] = None,
+        status: Optional[str] = None,
+        include_answers: bool = False
+):
+    """
+    One page of tests in id order, starting after `after_id`. Keyset rather
+    than OFFSET pagination, so every page costs the same however large the
+    catalog is. Answer keys are only read when include_answers is set.
+    Returns (tests, after_id of the next page or None on the last page).
+    """
+    query = select(models.Test) if include_answers else select(*TEST_SUMMARY_COLUMNS)
+    if after_id is not None:
+        query = query.where(models.Test.id > after_id)
+    if status is not None:
+        query = query.where(models.Test.status == status)
+    # One extra row tells whether another page follows
+    result = await db.execute(query.order_by(models.Test.id).limit(limit + 1))
+    tests = result.scalars().all() if include_answers else result.all()
+    next_after = tests[limit - 1].id if len(tests) > limit else None
+    return tests[:limit], next_after
 
 
 async def save_single_test(test: models.Test, db: AsyncSession):
     db.add(test)
     await db.commit()
+    await invalidation_channel.publish(db, test.test_id)
+    build_reference_expressions(test.test_id, test.answers_36_45)
     return test
 
 async def update_test(test_id: str, updated_data: dict, db: AsyncSession):
@@ -119,9 +274,20 @@ async def update_test(test_id: str, updated_data: dict, db: AsyncSession):
             if hasattr(test, key):
                 setattr(test, key, value)
 
+        # A new answer key invalidates the stored Rasch item calibration
+        if 'answers_1_35' in updated_data or 'answers_36_45' in updated_data:
+            await db.execute(
+                delete(models.RaschCalibration).where(models.RaschCalibration.test_id == test_id)
+            )
+
         await db.commit()
         await db.refresh(test)
 
+        # Drops cached answer keys and reference expressions in every worker
+        await invalidation_channel.publish(db, test_id)
+        if 'answers_36_45' in updated_data:
+            build_reference_expressions(test_id, test.answers_36_45)
+
     return test
 
 
@@ -131,187 +297,286 @@ async def delete_test(test_id: str, db: AsyncSession):
     )
     test = result.scalar_one_or_none()
     if test:
+        await db.execute(
+            delete(models.RaschCalibration).where(models.RaschCalibration.test_id == test_id)
+        )
         await db.delete(test)
         await db.commit()
+        await invalidation_channel.publish(db, test_id)
     return test  # Return deleted object or None
 
 
+async def get_rasch_calibration(db: AsyncSession, test_id: str):
+    result = await db.execute(
+        select(models.RaschCalibration).where(models.RaschCalibration.test_id == test_id)
+    )
+    return result.scalar_one_or_none()
+
+
+async def save_rasch_calibration(db: AsyncSession, test_id: str, item_difficulty, n_persons: int):
+    calibration = await get_rasch_calibration(db, test_id)
+    if calibration is None:
+        calibration = models.RaschCalibration(test_id=test_id)
+        db.add(calibration)
+
+    calibration.item_difficulty = [float(b) for b in item_difficulty]
+    calibration.n_persons = n_persons
+    await db.commit()
+    return calibration
+
+
 
 
 logger = logging.getLogger(__name__)
 
-async def  export_test_results(db: AsyncSession, test_id: str) -> Tuple[BytesIO, str]:
+# Background grading of new submissions waits for these, so a burst of submits
+# does not fill the threadpool with calls queued on the sympy guard
+_background_grading_slots = None
+
+# Rows fetched, graded and written per step of a streamed export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "2000"))
+EXPORT_WRITERS = {
+    "xlsx": ResultsXlsxWriter,
+    "csv": ResultsCsvWriter,
+}
+
+def results_query(test_id: str, key_hash: str):
     """
-    Export test results to an Excel file with 1/0 scoring.
-    Returns a tuple of (BytesIO containing the file, filename).
+    Submission columns needed to build the results table, in export order.
+    Raw answers are only sent for rows whose stored grades are missing or stale;
+    the rest need just their 8-byte correct_mask.
+    """
+    graded = and_(models.Submission.key_hash == key_hash, models.Submission.correct_mask.isnot(None))
+    return (
+        select(
+            models.Submission.firstname,
+            models.Submission.secondname,
+            models.Submission.thirdname,
+            models.Submission.region,
+            case((graded, None), else_=models.Submission.answers_1_35).label("answers_1_35"),
+            case((graded, None), else_=models.Submission.answers_36_45).label("answers_36_45"),
+            models.Submission.correct_mask,
+            models.Submission.key_hash
+        )
+        .where(models.Submission.test_id == test_id)
+        .order_by(models.Submission.secondname, models.Submission.firstname)
+    )
+
+
+async def get_test_submissions(db: AsyncSession, test_id: str):
+    """
+    Load the answer key and every submission row for a test.
+    Returns (answer key, list of row dicts) ready to hand to a worker process.
     """
-    # Get test correct answers
-    test = await get_test_by_id(db, test_id)
+    test = await get_answer_key(db, test_id)
     if not test:
         raise ValueError("Test not found")
 
-    correct_answers = test.answers_1_35
-    correct_36_45 = test.answers_36_45
+    # Get all user data
+    with metrics.timed("db_fetch"):
+        records = await db.execute(results_query(test_id, test.key_hash))
+        records = records.fetchall()
+    if not records:
+        raise ValueError("No submissions for this test yet")
 
-    # Get all user answers - note the table name format matches your actual table
-    table_name = f"test_{test_id.lower()}_answers"
+    return test, [dict(record._mapping) for record in records]
 
-    # Check if table exists
-    exists = await db.execute(
-        text("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = :table_name)"),
-        {"table_name": table_name}
-    )
-    if not exists.scalar():
-        raise ValueError("No submissions for this test yet")
 
-    # Get all user data
-    records = await db.execute(
-        text(f"""
-            SELECT firstname, secondname, thirdname, region, answers_1_35, answers_36_45
-            FROM {table_name}
-            ORDER BY secondname, firstname
-        """)
+async def open_results_export(db: AsyncSession, test_id: str, fmt: str = "xlsx") -> Tuple[AsyncIterator[bytes], str, str]:
+    """
+    Check that a test has results to export before any bytes are sent.
+    Returns (chunk iterator, filename, media type).
+    """
+    test = await get_answer_key(db, test_id)
+    if not test:
+        raise ValueError("Test not found")
+    first = await db.scalar(
+        select(models.Submission.id).where(models.Submission.test_id == test_id).limit(1)
     )
-    records = records.fetchall()
-
-    # Process data for Excel
-    data = []
-    count = 1
-    for record in records:
-        user_answers = (record.answers_1_35 or "").strip()
-
-        # Handle answers_36_45 which is already a dict in your case
-        user_math_answers = record.answers_36_45 or {}
-
-        row = {
-            '№': count,
-            'F.I.O': f"{record.firstname} {record.secondname} {record.thirdname} ({record.region})"
-        }
-        count += 1
-
-        # Binary for 1–35
-        for i in range(len(user_answers)):
-            question_num = i + 1
-            is_correct = (i < len(correct_answers)) and (user_answers[i].upper() == correct_answers[i].upper())
-            row[str(question_num)] = 1 if is_correct else 0
-
-        # Binary for 36–45 (a and b)
-        for q in range(36, 46):
-            q_str = str(q)
-            for part in ['a', 'b']:
-                user_latex = user_math_answers.get(q_str, {}).get(part, "")
-                correct_expr = correct_36_45.get(q_str, {}).get(part, "")
-
-                if not isinstance(user_latex, str) or not user_latex.strip():
-                    result = 0
-                else:
-                    result = 1 if is_expression_equal(user_latex, correct_expr) else 0
+    if first is None:
+        raise ValueError("No submissions for this test yet")
 
-                row[f"{q}{part}"] = result
+    writer_class = EXPORT_WRITERS[fmt]
+    return stream_test_results(test, writer_class), f"test_{test_id}_natijalar.{fmt}", writer_class.media_type
 
-        data.append(row)
 
-    # Create DataFrame
-    df = pd.DataFrame(data)
+async def stream_test_results(test: AnswerKey, writer_class) -> AsyncIterator[bytes]:
+    """
+    Stream the 1/0 results table: rows come from a server-side cursor and are
+    graded and written EXPORT_CHUNK_SIZE at a time, so memory stays bounded.
+    Opens its own session because it outlives the request's dependencies.
+    """
+    writer = writer_class(grading.result_columns(test.answers_1_35))
+    yield writer.header()
 
-    # Define column order
-    cols = ['№', 'F.I.O'] + [str(i + 1) for i in range(len(correct_answers))] + \
-           [f"{q}{part}" for q in range(36, 46) for part in ['a', 'b']]
-    df = df[cols]
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(
+            results_query(test.test_id, test.key_hash).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        )
+        partitions = result.mappings().partitions()
+        start = 1
+        while True:
+            with metrics.timed("db_fetch"):
+                partition = await anext(partitions, None)
+            if partition is None:
+                break
+            records = [dict(record) for record in partition]
+            with metrics.timed("grading"):
+                graded = await run_cpu_bound(
+                    grading.grade_responses, records, test.answers_1_35, test.answers_36_45, test.test_id
+                )
+            for stage, seconds in graded.timings.items():
+                metrics.observe_stage(stage, seconds)
+            with metrics.timed("render"):
+                chunk = await run_in_threadpool(writer.write_rows, records, graded.responses, start)
+            if chunk:
+                yield chunk
+            start += len(records)
+
+    with metrics.timed("render"):
+        content = await run_in_threadpool(writer.close)
+    yield content
+
+
+async def  export_test_results(db: AsyncSession, test_id: str, progress=None) -> Tuple[BytesIO, str]:
+    """
+    Export test results to an Excel file with 1/0 scoring.
+    Returns a tuple of (BytesIO containing the file, filename).
+    """
+    if progress:
+        progress("fetching")
+    chunks, filename, _ = await open_results_export(db, test_id)
 
-    # Create Excel file in memory
+    if progress:
+        progress("grading")
     output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Natijalar')
-
-        # Auto-adjust column widths
-        worksheet = writer.sheets['Natijalar']
-        for i, col in enumerate(df.columns):
-            max_len = max(df[col].astype(str).map(len).max(), len(col)) + 2
-            worksheet.set_column(i, i, max_len)
-
-    output.seek(0)
-    filename = f"test_{test_id}_natijalar.xlsx"
+    async for chunk in chunks:
+        output.write(chunk)
     return output, filename
 
 
-async def export_df_results(db: AsyncSession, test_id: str) -> Tuple[BytesIO, str]:
+async def rasch_results_version(db: AsyncSession, test_id: str) -> str:
     """
-    Export test results to an Excel file with 1/0 scoring.
-    Returns a tuple of (BytesIO containing the file, filename).
+    Version of a test's submission set: row count, highest id and answer-key
+    hash. Any new or removed submission or key edit changes it. Quoted so it
+    can be sent as an ETag.
     """
-    # Get test correct answers
-    test = await get_test_by_id(db, test_id)
+    test = await get_answer_key(db, test_id)
     if not test:
         raise ValueError("Test not found")
-
-    correct_answers = test.answers_1_35
-    correct_36_45 = test.answers_36_45
-
-    # Get all user answers - note the table name format matches your actual table
-    table_name = f"test_{test_id.lower()}_answers"
-
-    # Check if table exists
-    exists = await db.execute(
-        text("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = :table_name)"),
-        {"table_name": table_name}
-    )
-    if not exists.scalar():
+    count, last_id = (await db.execute(
+        select(func.count(), func.max(models.Submission.id))
+        .where(models.Submission.test_id == test_id)
+    )).one()
+    if not count:
         raise ValueError("No submissions for this test yet")
+    return f'"{count}-{last_id}-{test.key_hash}"'
 
-    # Get all user data
-    records = await db.execute(
-        text(f"""
-            SELECT firstname, secondname, thirdname, region, answers_1_35, answers_36_45
-            FROM {table_name}
-            ORDER BY secondname, firstname
-        """)
+
+async def get_rasch_results(db: AsyncSession, test_id: str, version: Optional[str] = None, progress=None) -> RaschResult:
+    """
+    Rasch analysis of the current submission set, computed once per version
+    and served from rasch_result_cache afterwards.
+    """
+    if version is None:
+        version = await rasch_results_version(db, test_id)
+    cached = rasch_result_cache.get(test_id, version)
+    if cached is not None:
+        return cached
+
+    if progress:
+        progress("fetching")
+    test, records = await get_test_submissions(db, test_id)
+    calibration = await get_rasch_calibration(db, test_id)
+
+    # Grading and fitting run in one worker call; the results frame never
+    # reaches the web process
+    if progress:
+        progress("fitting")
+    output = await run_analysis(
+        "run_rasch_from_records",
+        records, test.answers_1_35, test.answers_36_45, test.test_id,
+        calibration.item_difficulty if calibration is not None else None,
+        calibration.n_persons if calibration is not None else None,
+        zlib.crc32(version.encode())
     )
-    records = records.fetchall()
-
-    # Process data for Excel
-    data = []
-    count = 1
-    for record in records:
-        user_answers = (record.answers_1_35 or "").strip()
-
-        # Handle answers_36_45 which is already a dict in your case
-        user_math_answers = record.answers_36_45 or {}
-
-        row = {
-            '№': count,
-            'F.I.O': f"{record.firstname} {record.secondname} {record.thirdname} ({record.region})"
-        }
-        count += 1
-
-        # Binary for 1–35
-        for i in range(len(user_answers)):
-            question_num = i + 1
-            is_correct = (i < len(correct_answers)) and (user_answers[i].upper() == correct_answers[i].upper())
-            row[str(question_num)] = 1 if is_correct else 0
-
-        # Binary for 36–45 (a and b)
-        for q in range(36, 46):
-            q_str = str(q)
-            for part in ['a', 'b']:
-                user_latex = user_math_answers.get(q_str, {}).get(part, "")
-                correct_expr = correct_36_45.get(q_str, {}).get(part, "")
+    # Stages ran in a worker process; record them here
+    for stage, seconds in output.timings.items():
+        metrics.observe_stage(stage, seconds)
+    if output.item_difficulty is not None:
+        await save_rasch_calibration(db, test_id, output.item_difficulty, output.n_persons)
 
-                if not isinstance(user_latex, str) or not user_latex.strip():
-                    result = 0
-                else:
-                    result = 1 if is_expression_equal(user_latex, correct_expr) else 0
+    result = RaschResult(version, output.content, f"rasch_{test_id}_natijalar.xlsx", output.scores)
+    rasch_result_cache.put(test_id, result)
+    return result
 
-                row[f"{q}{part}"] = result
 
-        data.append(row)
+async def export_rasch_results(db: AsyncSession, test_id: str, progress=None) -> Tuple[BytesIO, str]:
+    """
+    Run Rasch analysis on the graded results and export the ranked scores.
+    Returns a tuple of (BytesIO containing the file, filename).
+    """
+    result = await get_rasch_results(db, test_id, progress=progress)
+    return BytesIO(result.content), result.filename
 
-    # Create DataFrame
-    df = pd.DataFrame(data)
 
-    # Define column order
-    cols = ['№', 'F.I.O'] + [str(i + 1) for i in range(len(correct_answers))] + \
-           [f"{q}{part}" for q in range(36, 46) for part in ['a', 'b']]
-    df = df[cols]
+async def grade_stored_submission(submission_id: int, test_id: str, data: dict):
+    """
+    Grade a just-stored submission so exports and Rasch analysis can reuse its
+    bitmask. Runs as a background task after the response with its own
+    session; if grading fails the row stays ungraded and is graded on read.
+    """
+    global _background_grading_slots
+    if _background_grading_slots is None:
+        _background_grading_slots = asyncio.Semaphore(SYMPY_WORKERS)
+
+    try:
+        async with _background_grading_slots, AsyncSessionLocal() as db:
+            test = await get_answer_key(db, test_id)
+            if not test:
+                return
+            with metrics.timed("grading"):
+                mask, score = await run_in_threadpool(
+                    grading.grade_submission,
+                    data["answers_1_35"], data["answers_36_45"],
+                    test.answers_1_35, test.answers_36_45, test.test_id
+                )
+            await db.execute(
+                update(models.Submission)
+                .where(models.Submission.id == submission_id)
+                .values(correct_mask=mask, total_score=score, key_hash=test.key_hash)
+            )
+            await db.commit()
+    except Exception as e:
+        logger.warning(f"Leaving submission {submission_id} of test {test_id} ungraded: {e!r}")
+
+
+async def regrade_submissions(test_id: str):
+    """
+    Re-grade every stored submission of a test after its answer key changed.
+    Runs as a background task with its own session.
+    """
+    async with AsyncSessionLocal() as db:
+        test = await get_test_by_id(db, test_id)
+        if not test:
+            return
+        test = to_answer_key(test)
+
+        records = await db.execute(
+            select(
+                models.Submission.id,
+                models.Submission.answers_1_35,
+                models.Submission.answers_36_45
+            ).where(models.Submission.test_id == test_id)
+        )
+        records = [dict(record._mapping) for record in records.fetchall()]
+        if not records:
+            return
 
-    return df
\ No newline at end of file
+        grades = await run_cpu_bound(
+            grading.grade_submissions, records, test.answers_1_35, test.answers_36_45, test.test_id
+        )
+        # ORM bulk UPDATE by primary key
+        await db.execute(update(models.Submission), grades)
+        await db.commit()
+        logger.info(f"Re-graded {len(grades)} submissions of test {test_id}")
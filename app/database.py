@@ -1,16 +1,36 @@
+import time
+
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 import os
 from dotenv import load_dotenv
 
+from app.metrics import pool_checkout_duration
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Log every SQL statement; only useful while debugging
+DB_ECHO = os.getenv("DB_ECHO", "0") == "1"
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waits for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_checkout_duration.observe(time.perf_counter() - start)
+
 
 # Async engine setup
 engine = create_async_engine(
     DATABASE_URL,
-    echo=True,  # Set to False in production
+    echo=DB_ECHO,
+    poolclass=TimedQueuePool,
     pool_size=20,
     max_overflow=10
 )
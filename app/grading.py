@@ -0,0 +1,226 @@
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.utils import answer_key_hash, grade_reference_batch, mcq_key
+
+FREE_RESPONSE_PARTS = [(str(q), part) for q in range(36, 46) for part in ['a', 'b']]
+
+# submissions.correct_mask is a signed BIGINT, so a stored mask holds 63 columns
+MASK_BITS = 63
+MAX_MCQ_ITEMS = MASK_BITS - len(FREE_RESPONSE_PARTS)
+
+
+def result_columns(correct_answers) -> List[str]:
+    """Response columns in grading order: 1..35, then 36a, 36b, ..., 45b."""
+    return [str(i + 1) for i in range(len(correct_answers))] + \
+           [f"{q}{part}" for q, part in FREE_RESPONSE_PARTS]
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    """Set bits in each row of a (rows x words) uint64 array."""
+    if hasattr(np, "bitwise_count"):  # NumPy 2.0+
+        return np.bitwise_count(values).sum(axis=1, dtype=np.int64)
+    return np.unpackbits(values.view(np.uint8).reshape(len(values), -1), axis=1).sum(axis=1, dtype=np.int64)
+
+
+def _mask_words(n_columns: int) -> int:
+    return max(1, -(-n_columns // 64))
+
+
+class ResponseMatrix:
+    """
+    0/1 correctness of every examinee on every result column, packed as uint64
+    words per examinee with bit k of word w set when column 64 * w + k is correct
+    (word 0 is the layout of submissions.correct_mask). 8 bytes a row instead of
+    a row of 55 cells for the usual key; np.asarray() unpacks it to the int8
+    matrix pandas and FastRaschModel expect.
+    """
+    __slots__ = ("masks", "columns", "n_mcq")
+
+    def __init__(self, masks: np.ndarray, columns: List[str], n_mcq: int):
+        self.masks = np.asarray(masks, dtype=np.uint64).reshape(-1, _mask_words(len(columns)))
+        self.columns = columns
+        self.n_mcq = n_mcq
+
+    @classmethod
+    def from_dense(cls, responses: np.ndarray, columns: List[str], n_mcq: int) -> "ResponseMatrix":
+        n_words = _mask_words(len(columns))
+        padded = np.zeros((len(responses), n_words * 64), dtype=np.uint64)
+        padded[:, :len(columns)] = responses
+        weights = np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))
+        return cls(padded.reshape(len(responses), n_words, 64) @ weights, columns, n_mcq)
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.masks), len(self.columns)
+
+    def dense(self) -> np.ndarray:
+        """Unpack into an int8 (rows x columns) matrix, 1 = correct."""
+        bits = (self.masks[:, :, np.newaxis] >> np.arange(64, dtype=np.uint64)) & 1
+        return bits.reshape(len(self.masks), -1)[:, :len(self.columns)].astype(np.int8)
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.dense()
+        return dense if dtype is None else dense.astype(dtype)
+
+    def raw_scores(self) -> np.ndarray:
+        """1 per correct MCQ and 0.5 per correct free-response part, by popcount."""
+        mcq_bits = ResponseMatrix.from_dense(
+            (np.arange(len(self.columns)) < self.n_mcq).reshape(1, -1), self.columns, self.n_mcq
+        ).masks
+        return _popcount(self.masks & mcq_bits) + 0.5 * _popcount(self.masks & ~mcq_bits)
+
+
+class GradedResponses(NamedTuple):
+    """Output of the grading engine, shared by exports, Rasch and re-grading."""
+    matrix: ResponseMatrix
+    key_hash: str
+    timings: Dict[str, float]  # seconds per grading stage, for metrics
+    undecided: np.ndarray  # bool per row: a comparison timed out, so the row is graded again on read
+
+    @property
+    def columns(self) -> List[str]:
+        return self.matrix.columns
+
+    @property
+    def responses(self) -> np.ndarray:
+        """int8 (rows x result_columns()), 1 = correct."""
+        return self.matrix.dense()
+
+    @property
+    def scores(self) -> np.ndarray:
+        return self.matrix.raw_scores()
+
+    def masks(self) -> List[Optional[int]]:
+        """
+        Each row's bitmask as stored in submissions.correct_mask; None for
+        undecided rows and for keys with more than MASK_BITS columns, which
+        must be graded on read.
+        """
+        if len(self.columns) > MASK_BITS:
+            return [None] * len(self.matrix)
+        return [None if undecided else mask for mask, undecided in zip(self.matrix.masks[:, 0].tolist(), self.undecided)]
+
+
+def _upper_letters(answers: str) -> str:
+    """Upper-case each answer letter in place; one that upper-cases to several (ß) is kept as is."""
+    upper = answers.upper()
+    if len(upper) == len(answers):
+        return upper
+    return "".join(u if len(u) == 1 else c for c, u in ((c, c.upper()) for c in answers))
+
+
+def encode_mcq(answers: Sequence[Optional[str]], n_items: int) -> np.ndarray:
+    """
+    Pack multiple-choice answer strings into a uint32 (rows x n_items) matrix of
+    code points, so keys in any alphabet compare as they do in check_answers.
+    Short strings are padded with NUL, which never matches a key letter.
+    """
+    if n_items == 0:
+        return np.zeros((len(answers), 0), dtype=np.uint32)
+    padded = [_upper_letters((answer or "").strip()[:n_items]).ljust(n_items, "\0") for answer in answers]
+    return np.array(padded, dtype=f"<U{n_items}").view(np.uint32).reshape(len(answers), n_items)
+
+
+def encode_mcq_key(correct_answers: Sequence[str]) -> np.ndarray:
+    # Entries that are not a single letter get a value past the last code point
+    # and never match
+    return np.array(
+        [ord(_upper_letters(k)) if len(k) == 1 else 0x110000 for k in correct_answers],
+        dtype=np.uint32
+    )
+
+
+def grade_responses(
+        records: Sequence[Dict[str, Any]],
+        correct_answers,
+        correct_36_45,
+        test_id: str
+) -> GradedResponses:
+    """
+    Grade rows into a ResponseMatrix. Rows graded at submission time with the
+    current answer key keep their stored bitmask as is. The rest are graded with
+    one broadcast comparison for the MCQ block, and each distinct free-response
+    answer is checked once per part.
+    Pure CPU work, safe to run in a worker process.
+    """
+    key_hash = answer_key_hash(correct_answers, correct_36_45)
+    correct_answers = mcq_key(correct_answers)
+    n_mcq = len(correct_answers)
+    columns = result_columns(correct_answers)
+    masks = np.zeros((len(records), _mask_words(len(columns))), dtype=np.uint64)
+    undecided = np.zeros(len(records), dtype=bool)
+
+    pending = []
+    for i, record in enumerate(records):
+        if record.get("correct_mask") is not None and record.get("key_hash") == key_hash:
+            masks[i, 0] = record["correct_mask"]
+        else:
+            pending.append(i)
+
+    timings = {}
+    if pending:
+        responses = np.zeros((len(pending), len(columns)), dtype=np.int8)
+        # Multiple choice: one vectorized comparison against the key
+        start = time.perf_counter()
+        user_mcq = encode_mcq([records[i]["answers_1_35"] for i in pending], n_mcq)
+        responses[:, :n_mcq] = user_mcq == encode_mcq_key(correct_answers)
+        timings["grading_mcq"] = time.perf_counter() - start
+
+        # Free response: one batch per column, each distinct answer compared once
+        for k, (q_str, part) in enumerate(FREE_RESPONSE_PARTS):
+            answers = [(records[i]["answers_36_45"] or {}).get(q_str, {}).get(part, "") for i in pending]
+            given = [j for j, answer in enumerate(answers) if isinstance(answer, str) and answer.strip()]
+            if not given:
+                continue
+            verdicts = grade_reference_batch(
+                test_id, correct_36_45, q_str, part, dict.fromkeys(answers[j] for j in given)
+            )
+            responses[given, n_mcq + k] = [bool(verdicts[answers[j]]) for j in given]
+            undecided[[pending[j] for j in given if verdicts[answers[j]] is None]] = True
+        timings["grading_free_response"] = time.perf_counter() - start - timings["grading_mcq"]
+        masks[pending] = ResponseMatrix.from_dense(responses, columns, n_mcq).masks
+
+    return GradedResponses(ResponseMatrix(masks, columns, n_mcq), key_hash, timings, undecided)
+
+
+def grade_submission(
+        answers_1_35: Optional[str],
+        answers_36_45: Optional[Dict[str, Any]],
+        correct_answers,
+        correct_36_45,
+        test_id: str
+) -> Tuple[Optional[int], float]:
+    """
+    Grade one submission. Returns (bitmask with bit k set when the k-th column of
+    result_columns() is correct, or None if it must not be stored, total score
+    with 1 per MCQ and 0.5 per part).
+    """
+    graded = grade_responses(
+        [{"answers_1_35": answers_1_35, "answers_36_45": answers_36_45}],
+        correct_answers, correct_36_45, test_id
+    )
+    return graded.masks()[0], float(graded.scores[0])
+
+
+def grade_submissions(
+        records: Sequence[Dict[str, Any]],
+        correct_answers,
+        correct_36_45,
+        test_id: str
+) -> List[Dict[str, Any]]:
+    """Grade stored rows; returns UPDATE parameters for each row id."""
+    graded = grade_responses(records, correct_answers, correct_36_45, test_id)
+    return [
+        {"id": record["id"], "correct_mask": mask, "total_score": float(score), "key_hash": graded.key_hash}
+        for record, mask, score in zip(records, graded.masks(), graded.scores)
+    ]
+
+
+def full_name(record: Dict[str, Any]) -> str:
+    return f"{record['firstname']} {record['secondname']} {record['thirdname']} ({record['region']})"
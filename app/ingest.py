@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app import crud, metrics
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+# Write-behind mode for /submit-answers: submissions are queued and stored in
+# multi-row INSERTs every SUBMIT_BATCH_SIZE rows or SUBMIT_FLUSH_MS milliseconds
+SUBMIT_WRITE_BEHIND = os.getenv("SUBMIT_WRITE_BEHIND", "0") == "1"
+SUBMIT_BATCH_SIZE = int(os.getenv("SUBMIT_BATCH_SIZE", "500"))
+SUBMIT_FLUSH_MS = int(os.getenv("SUBMIT_FLUSH_MS", "50"))
+# Submissions waiting to be written before new ones are turned away with 503
+SUBMIT_QUEUE_LIMIT = int(os.getenv("SUBMIT_QUEUE_LIMIT", "10000"))
+
+# asyncpg accepts at most 32767 bind parameters per statement (12 per row)
+_MAX_BATCH_SIZE = 32767 // 12
+
+PendingSubmission = Tuple[dict, asyncio.Future]
+
+
+class SubmissionBatcher:
+    """
+    Collects submit payloads in an in-process queue and writes them in batches.
+    Each caller awaits its own future, resolved with the outcome of its row.
+    """
+
+    def __init__(self, batch_size: int, flush_ms: int, queue_limit: int):
+        self.batch_size = max(1, min(batch_size, _MAX_BATCH_SIZE))
+        self.flush_interval = flush_ms / 1000
+        self._queue: "asyncio.Queue[PendingSubmission]" = asyncio.Queue(maxsize=queue_limit)
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, test_id: str, data: dict) -> int:
+        """Queue a submission and wait until it is stored; returns the new row id."""
+        if self._stopping or self._task is None or self._task.done():
+            raise HTTPException(status_code=503, detail="Submission queue is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((crud.submission_row(test_id, data), future))
+        except asyncio.QueueFull:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many pending submissions, retry shortly",
+                headers={"Retry-After": "1"}
+            )
+
+        submission_id = await future
+        if submission_id is None:
+            raise HTTPException(
+                status_code=403,
+                detail=f"User telegram id already exists."
+            )
+        return submission_id
+
+    async def _next_batch(self) -> Tuple[List[PendingSubmission], bool]:
+        # Returns (batch, stop); None in the queue is the shutdown marker
+        item = await self._queue.get()
+        if item is None:
+            return [], True
+
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        while True:
+            batch, stop = await self._next_batch()
+            if batch:
+                await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, batch: List[PendingSubmission]):
+        # The same user twice in one batch: the first row wins, like separate INSERTs
+        rows, futures, seen = [], {}, set()
+        for row, future in batch:
+            key = (row["test_id"], row["telegram_id"])
+            if key in seen:
+                if not future.done():
+                    future.set_result(None)
+                continue
+            seen.add(key)
+            rows.append(row)
+            futures[key] = future
+
+        try:
+            with metrics.timed("db_write_batch"):
+                async with engine.connect() as conn:
+                    conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                    result = await conn.execute(crud.insert_submissions_statement(rows))
+                    stored = {(row.test_id, row.telegram_id): row.id for row in result}
+        except Exception as e:
+            logger.error(f"Failed to store {len(rows)} queued submissions: {str(e)}", exc_info=True)
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(HTTPException(status_code=500, detail="Could not store submission"))
+            return
+
+        for key, future in futures.items():
+            if not future.done():
+                future.set_result(stored.get(key))
+
+    async def stop(self):
+        """Stop accepting work, write everything still queued and wait for it."""
+        if self._task is None:
+            return
+        self._stopping = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+
+submission_batcher: Optional[SubmissionBatcher] = None
+
+
+def start_submission_batcher():
+    global submission_batcher
+    if SUBMIT_WRITE_BEHIND and submission_batcher is None:
+        submission_batcher = SubmissionBatcher(SUBMIT_BATCH_SIZE, SUBMIT_FLUSH_MS, SUBMIT_QUEUE_LIMIT)
+        submission_batcher.start()
+
+
+async def stop_submission_batcher():
+    global submission_batcher
+    if submission_batcher is not None:
+        await submission_batcher.stop()
+        submission_batcher = None
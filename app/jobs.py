@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional, Tuple
+
+from app.database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# How many finished jobs (and their result files) are kept for download
+MAX_FINISHED_JOBS = int(os.getenv("MAX_FINISHED_JOBS", "100"))
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    test_id: str
+    status: str = "pending"  # pending -> running -> done | failed
+    stage: str = "queued"
+    error: Optional[str] = None
+    filename: Optional[str] = None
+    content: Optional[bytes] = field(default=None, repr=False)
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: Optional[datetime] = None
+
+
+# Job runner: (db session, test_id, progress callback) -> (BytesIO, filename)
+JobRunner = Callable[..., Awaitable[Tuple[bytes, str]]]
+
+_jobs: "OrderedDict[str, Job]" = OrderedDict()
+_tasks = set()
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    return _jobs.get(job_id)
+
+
+def start_job(kind: str, test_id: str, runner: JobRunner) -> Job:
+    job = Job(id=uuid.uuid4().hex, kind=kind, test_id=test_id)
+    _jobs[job.id] = job
+
+    task = asyncio.create_task(_run(job, runner))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return job
+
+
+async def _run(job: Job, runner: JobRunner):
+    def progress(stage: str):
+        job.stage = stage
+
+    job.status = "running"
+    try:
+        # The request session is gone by now, so jobs open their own
+        async with AsyncSessionLocal() as db:
+            output, job.filename = await runner(db, job.test_id, progress=progress)
+        job.content = output.getvalue()
+        job.status = "done"
+        job.stage = "finished"
+    except Exception as e:
+        logger.error(f"{job.kind} job {job.id} failed: {str(e)}", exc_info=True)
+        job.status = "failed"
+        job.error = str(e)
+    finally:
+        job.finished_at = datetime.now(timezone.utc)
+        _evict_finished()
+
+
+def _evict_finished():
+    finished = [job_id for job_id, job in _jobs.items() if job.finished_at is not None]
+    for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+        del _jobs[job_id]
+
+
+async def shutdown():
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
@@ -1,14 +1,49 @@
-from fastapi import FastAPI
+import time
+
+_import_started = time.perf_counter()
+
+import logging
+import os
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from app.database import engine, Base
 from contextlib import asynccontextmanager
-from app.routers import router
+from app.routers import analytics_router, router
+from app import jobs, workers, ingest, metrics
+from app.answer_keys import invalidation_channel
+from app.crud import migrate_legacy_submission_tables
+from app.utils import sympy_guard
+
+logger = logging.getLogger(__name__)
+
+# "all" serves everything; "ingest" serves tests, answer checks and submissions
+# only, so its processes never load pandas, scipy or numba nor warm up Rasch
+# workers. Run exports and Rasch analysis on separate "all" instances.
+APP_ROLE = os.getenv("APP_ROLE", "all")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    started = time.perf_counter()
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await migrate_legacy_submission_tables(conn)
+    await invalidation_channel.start()
+    ingest.start_submission_batcher()
+    if workers.RASCH_WARMUP and APP_ROLE != "ingest":
+        workers.warm_up()
+    metrics.startup_seconds["lifespan"] = time.perf_counter() - started
+    logger.info(
+        f"Started as {APP_ROLE!r}: imports {metrics.startup_seconds['import']:.2f}s, "
+        f"startup {metrics.startup_seconds['lifespan']:.2f}s"
+    )
     yield
+    # Write queued submissions before anything else goes away
+    await ingest.stop_submission_batcher()
+    await jobs.shutdown()
+    workers.shutdown()
+    sympy_guard.shutdown()
+    await invalidation_channel.stop()
 
 app = FastAPI(
     title="Test Evaluation API",
@@ -24,7 +59,30 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-After"],  # GET /tests pagination cursor
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Streaming bodies are still being sent when call_next returns; they are
+    # timed up to the first byte
+    profile = metrics.profiler.start()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.request_duration.observe(elapsed, request.method, path, str(status))
+        metrics.profiler.finish(profile, f"{request.method} {path}", elapsed)
+
 # ✅ Route'ni ulash
 app.include_router(router)
+if APP_ROLE != "ingest":
+    app.include_router(analytics_router)
+
+metrics.startup_seconds["import"] = time.perf_counter() - _import_started
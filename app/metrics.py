@@ -0,0 +1,180 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Profile this fraction of requests with cProfile (0 disables the profiler)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Log the profile of a sampled request only when it took at least this long
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "1000"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "25"))
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Minimal Prometheus histogram: cumulative buckets, sum and count per label set."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, *labels: str):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # one counter per bucket, then sum and count
+                series = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-2] + values[-1:]):
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {count:g}")
+            plain_labels = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{plain_labels} {values[-2]:.6f}")
+            lines.append(f"{self.name}_count{plain_labels} {values[-1]:g}")
+        return lines
+
+
+request_duration = Histogram(
+    "app_http_request_duration_seconds", "Time spent handling HTTP requests.", ("method", "route", "status")
+)
+stage_duration = Histogram(
+    "app_stage_duration_seconds",
+    "Time spent in each stage of grading, export and Rasch analysis.",
+    ("stage",)
+)
+pool_checkout_duration = Histogram(
+    "app_db_pool_checkout_seconds",
+    "Time to obtain a connection from the database pool, including waiting for a free one.",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+)
+comparison_duration = Histogram(
+    "app_expression_comparison_seconds",
+    "Time to compare one free-response answer, by the tier that decided it.",
+    ("tier",)
+)
+
+
+# phase -> seconds: "import" for loading the app modules, "lifespan" for startup
+startup_seconds: Dict[str, float] = {}
+
+
+def observe_stage(stage: str, seconds: float):
+    stage_duration.observe(seconds, stage)
+
+
+@contextmanager
+def timed(stage: str):
+    """Record how long the block takes under app_stage_duration_seconds{stage=...}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.observe(time.perf_counter() - start, stage)
+
+
+def _gauge(name: str, documentation: str, samples: Iterable[Tuple[str, float]], kind: str = "gauge") -> List[str]:
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{labels} {value:g}" for labels, value in samples)
+    return lines
+
+
+def render(caches: Dict[str, Dict[str, float]], tiers: Dict[str, int], pool: Dict[str, int]) -> str:
+    """Prometheus text exposition of every metric, plus caches, tiers and pool state sampled now."""
+    lines = []
+    for histogram in (request_duration, stage_duration, pool_checkout_duration, comparison_duration):
+        lines.extend(histogram.render())
+    lines.extend(_gauge(
+        "app_cache_hits_total", "Cache lookups that found a usable entry.",
+        [(f'{{cache="{name}"}}', stats["hits"]) for name, stats in caches.items()], "counter"
+    ))
+    lines.extend(_gauge(
+        "app_cache_misses_total", "Cache lookups that had to compute the value.",
+        [(f'{{cache="{name}"}}', stats["misses"]) for name, stats in caches.items()], "counter"
+    ))
+    lines.extend(_gauge(
+        "app_cache_hit_ratio", "Hits over lookups since the process started.",
+        [(f'{{cache="{name}"}}', stats["hit_ratio"]) for name, stats in caches.items()]
+    ))
+    lines.extend(_gauge(
+        "app_cache_entries", "Entries currently held.",
+        [(f'{{cache="{name}"}}', stats["size"]) for name, stats in caches.items()]
+    ))
+    lines.extend(_gauge(
+        "app_expression_comparisons_total", "Free-response comparisons by the tier that decided them.",
+        [(f'{{tier="{tier}"}}', count) for tier, count in sorted(tiers.items())], "counter"
+    ))
+    lines.extend(_gauge(
+        "app_db_pool_connections", "Database pool connections by state.",
+        [(f'{{state="{state}"}}', count) for state, count in pool.items()]
+    ))
+    lines.extend(_gauge(
+        "app_startup_seconds", "Time this worker process spent starting up, by phase.",
+        [(f'{{phase="{phase}"}}', seconds) for phase, seconds in startup_seconds.items()]
+    ))
+    return "\n".join(lines) + "\n"
+
+
+class RequestProfiler:
+    """
+    Samples requests with cProfile and logs the hottest functions of the slow
+    ones. cProfile sees the whole event-loop thread, so only one request is
+    profiled at a time and concurrent requests show up in its profile too.
+    """
+
+    def __init__(self, sample_rate: float, slow_ms: float, top: int):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.top = top
+        self._active = False
+
+    def start(self) -> Optional[cProfile.Profile]:
+        if self.sample_rate <= 0 or self._active or random.random() >= self.sample_rate:
+            return None
+        self._active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile: Optional[cProfile.Profile], label: str, elapsed: float):
+        if profile is None:
+            return
+        profile.disable()
+        self._active = False
+        if elapsed * 1000 < self.slow_ms:
+            return
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(self.top)
+        logger.warning(f"Slow request {label} took {elapsed:.3f}s\n{output.getvalue()}")
+
+
+profiler = RequestProfiler(PROFILE_SAMPLE_RATE, PROFILE_SLOW_MS, PROFILE_TOP)
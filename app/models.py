@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Float, DateTime, JSON, ForeignKey, UniqueConstraint
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from app.database import Base
 
@@ -33,4 +34,64 @@ class Test(Base):
     max_grade = Column(Integer, default=93, nullable=False)
 
     # Automatic timestamp with timezone
-    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
\ No newline at end of file
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class RaschCalibration(Base):
+    __tablename__ = 'rasch_calibrations'
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    # One calibration per test; dropped together with the test
+    test_id = Column(
+        String(20),
+        ForeignKey('tests.test_id', ondelete='CASCADE'),
+        unique=True,
+        nullable=False
+    )
+
+    # Fitted item difficulties in response-column order
+    item_difficulty = Column(
+        JSON,
+        nullable=False,
+        comment="Stores item difficulties as [beta_1, beta_2, ...]"
+    )
+
+    # Number of examinees the difficulties were estimated on
+    n_persons = Column(Integer, nullable=False)
+
+    updated_at = Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
+        nullable=False
+    )
+
+
+class Submission(Base):
+    __tablename__ = 'submissions'
+    __table_args__ = (
+        # One sheet per Telegram user and test; also serves lookups by test_id
+        UniqueConstraint('test_id', 'telegram_id', name='uq_submissions_test_id_telegram_id'),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+
+    test_id = Column(String(20), nullable=False)
+    telegram_id = Column(BigInteger, nullable=False)
+
+    firstname = Column(Text)
+    secondname = Column(Text)
+    thirdname = Column(Text)
+    region = Column(Text)
+
+    # Raw answers as submitted: 'ABCD...' and {'36': {'a': '42', 'b': '3.14'}, ...}
+    answers_1_35 = Column(Text)
+    answers_36_45 = Column(JSONB)
+
+    submission_time = Column(DateTime)
+
+    # Grades computed at submission time; bit k of correct_mask is the k-th result column
+    correct_mask = Column(BigInteger)
+    total_score = Column(Float)
+    key_hash = Column(String(16), comment="Fingerprint of the answer key the grades were computed with")
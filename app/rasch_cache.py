@@ -0,0 +1,38 @@
+import os
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from app.answer_keys import invalidation_channel
+from app.lru import LRUCache
+
+# Finished Rasch analyses kept in memory, most recently used first
+RASCH_CACHE_SIZE = int(os.getenv("RASCH_CACHE_SIZE", "32"))
+
+
+class RaschResult(NamedTuple):
+    """A finished Rasch analysis for one version of a test's submission set."""
+    version: str  # also the HTTP ETag
+    content: bytes
+    filename: str
+    scores: List[Dict[str, Any]]  # F.I.O., Theta, Ball, Daraja per person
+
+
+class RaschResultCache(LRUCache):
+    """
+    LRU cache of finished Rasch analyses by test_id. An entry is only served for
+    the version it was computed for, so new submissions or an answer-key edit
+    make it stale without any explicit call.
+    """
+
+    def get(self, test_id: str, version: str) -> Optional[RaschResult]:
+        return super().get(test_id, valid=lambda result: result.version == version)
+
+    def put(self, test_id: str, result: RaschResult):
+        super().put(test_id, result)
+
+    def invalidate(self, test_id: str):
+        self.pop(test_id)
+
+
+rasch_result_cache = RaschResultCache(RASCH_CACHE_SIZE)
+# Free the memory of edited or deleted tests right away
+invalidation_channel.subscribe(rasch_result_cache.invalidate)
@@ -0,0 +1,14 @@
+from typing import Any, Dict, List, NamedTuple, Optional
+
+
+class RaschOutput(NamedTuple):
+    """
+    What an analysis worker sends back from a Rasch run. Kept in a module with
+    no app imports, so neither unpickling it in the web process nor defining it
+    in a worker loads more than it needs.
+    """
+    content: bytes  # ranked results as xlsx
+    item_difficulty: Optional[List[float]]  # new calibration, None if unchanged
+    n_persons: int
+    scores: List[Dict[str, Any]]  # F.I.O., Theta, Ball, Daraja per person
+    timings: Dict[str, float]  # seconds per stage, for metrics
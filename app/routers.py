@@ -1,32 +1,50 @@
 # app/routers.py
 import os
-import tempfile
-from io import BytesIO
-
-import numpy as np
-import pandas as pd
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.openapi.models import Response
-from scipy.stats import zscore
+from typing import Literal, Optional
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.testing import db
-from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 
-from FastRaschModel import FastRaschModel
-from app import crud, schemas, models
-from app.crud import ensure_table_exists, insert_user_answers, export_test_results, logger, export_df_results
-from app.database import get_db
+from app import crud, schemas, models, jobs, ingest, metrics
+from app.answer_keys import answer_key_cache
+from app.rasch_cache import rasch_result_cache
+from app.crud import insert_user_answers, export_test_results, logger, export_rasch_results
+from app.database import engine, get_db
 from app.schemas import CheckAnswersResponse
-from app.utils import check_answers
-from fastapi.responses import FileResponse
+from app.utils import check_answers, comparison_tier_stats, sheet_error, verdict_cache
+from fastapi.responses import Response, StreamingResponse
 
 router = APIRouter()
+# Upper bound on sheets per /check-answers/batch request
+CHECK_BATCH_MAX_SHEETS = int(os.getenv("CHECK_BATCH_MAX_SHEETS", "1000"))
+# Exports, Rasch analysis and their jobs; left out of ingest-only deployments
+analytics_router = APIRouter()
 
 # Root endpoint
 @router.get("/")
 async def root():
     return {"message": "API is working", "docs": "/docs", "redoc": "/redoc"}
 
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """
+    Prometheus text format: request and stage latencies, pool checkout waits,
+    cache hit ratios and comparison tiers of this worker process.
+    """
+    pool = engine.sync_engine.pool
+    body = metrics.render(
+        caches={
+            "verdict": verdict_cache.stats(),
+            "answer_key": answer_key_cache.stats(),
+            "rasch_result": rasch_result_cache.stats(),
+        },
+        tiers=comparison_tier_stats(),
+        pool={"checked_out": pool.checkedout(), "idle": pool.checkedin(), "overflow": max(pool.overflow(), 0)}
+    )
+    return Response(content=body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @router.get("/tests/{test_id}", response_model=schemas.TestResponse)
 async def get_test(test_id: str, db: AsyncSession = Depends(get_db)):
     db_test = await crud.get_test_by_id(db, test_id)
@@ -36,17 +54,45 @@ async def get_test(test_id: str, db: AsyncSession = Depends(get_db)):
 
 @router.post("/check-answers", response_model=schemas.CheckAnswersResponse)
 async def check_all_answers(payload: schemas.CheckAnswersRequest, db: AsyncSession = Depends(get_db)):
-    test = await crud.get_test_by_id(db, payload.test_id)
+    test = await crud.get_answer_key(db, payload.test_id)
     if not test:
         raise HTTPException(status_code=404, detail="Test not found")
+    error = sheet_error(payload.answers_1_35, test)
+    if error:
+        raise HTTPException(status_code=422, detail=error)
 
-    result = check_answers(
+    # Grading may wait on the sympy pool, so keep it off the event loop
+    result = await run_in_threadpool(
+        check_answers,
         user_data={
             "answers_1_35": payload.answers_1_35,
             "answers_36_45": payload.answers_36_45,
         },
         correct_data=test
     )
+    return check_answers_response(result, test)
+
+
+@router.post("/check-answers/batch", response_model=schemas.CheckAnswersBatchResponse)
+async def check_answers_batch(payload: schemas.CheckAnswersBatchRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Check many answer sheets in one call. Each answer key is loaded once and
+    identical free-response answers are compared once for the whole batch.
+    Results come back in input order; a sheet for an unknown test or question
+    gets an error.
+    """
+    if len(payload.sheets) > CHECK_BATCH_MAX_SHEETS:
+        raise HTTPException(status_code=413, detail=f"At most {CHECK_BATCH_MAX_SHEETS} sheets per request")
+
+    checked = await crud.check_answer_sheets(db, payload.sheets)
+    return schemas.CheckAnswersBatchResponse(results=[
+        schemas.CheckAnswersBatchItem(test_id=sheet.test_id, result=check_answers_response(result, test))
+        if result is not None else schemas.CheckAnswersBatchItem(test_id=sheet.test_id, error=error)
+        for sheet, (test, result, error) in zip(payload.sheets, checked)
+    ])
+
+
+def check_answers_response(result: dict, test) -> CheckAnswersResponse:
     percentage = round(result["total_correct"] / test.max_grade * 100, 2)
     return CheckAnswersResponse(
         results_1_35=result["results_1_35"],
@@ -55,19 +101,58 @@ async def check_all_answers(payload: schemas.CheckAnswersRequest, db: AsyncSessi
         percentage=percentage
     )
 
-@router.post("/submit-answers")
-async def submit_answers(payload: schemas.SubmitAnswersRequest, db: AsyncSession = Depends(get_db)):
-    await ensure_table_exists(payload.test_id, db)
-    await crud.get_user_telegram_id(payload.test_id, payload.telegram_id, db)
 
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Match check: the header may be '*' or a comma-separated list of
+    tags, and is compared weakly, so W/"v" matches "v".
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
 
-    await insert_user_answers(payload.test_id, payload.dict(), db)
+@router.post("/submit-answers")
+async def submit_answers(
+        payload: schemas.SubmitAnswersRequest,
+        background_tasks: BackgroundTasks,
+        db: AsyncSession = Depends(get_db)
+):
+    data = payload.dict()
+    # Duplicate telegram_id -> 403, decided by the INSERT itself
+    if ingest.submission_batcher is not None:
+        # Hand the session's connection back to the pool for the batch flush
+        await db.close()
+        submission_id = await ingest.submission_batcher.submit(payload.test_id, data)
+    else:
+        submission_id = await insert_user_answers(payload.test_id, data, db)
+
+    # Stored ungraded; grading after the response fills in the bitmask that
+    # exports and Rasch analysis read
+    background_tasks.add_task(crud.grade_stored_submission, submission_id, payload.test_id, data)
     return {"message": "Answers submitted successfully"}
 
 
-@router.get("/tests", response_model=list[schemas.TestResponse])
-async def get_all_tests(db: AsyncSession = Depends(get_db)):
-    return await crud.get_all_tests(db)
+@router.get("/tests", response_model=list[schemas.TestResponse], response_model_exclude_none=True)
+async def get_all_tests(
+        response: Response,
+        limit: int = Query(100, ge=1, le=1000),
+        after_id: Optional[int] = Query(None, description="X-Next-After header of the previous page"),
+        status: Optional[str] = None,
+        include_answers: bool = False,
+        db: AsyncSession = Depends(get_db)
+):
+    """
+    List tests a page at a time, without their answer keys unless
+    include_answers=true. When more tests follow, the X-Next-After response
+    header holds the after_id of the next page.
+    """
+    tests, next_after = await crud.get_all_tests(db, limit, after_id, status, include_answers)
+    if next_after is not None:
+        response.headers["X-Next-After"] = str(next_after)
+    return tests
 
 @router.post("/insert-test", response_model=schemas.TestResponse)
 async def insert_test(test_data: schemas.TestCreate, db: AsyncSession = Depends(get_db)):
@@ -78,9 +163,15 @@ async def insert_test(test_data: schemas.TestCreate, db: AsyncSession = Depends(
 async def modify_test(
     test_id: str,
     update_data: schemas.TestUpdate,  # Optional: use `dict` if no schema
+    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(get_db)
 ):
-    test = await crud.update_test(test_id, update_data.dict(exclude_unset=True), db)
+    changes = update_data.dict(exclude_unset=True)
+    test = await crud.update_test(test_id, changes, db)
+
+    # Stored grades were computed with the old answer key
+    if test and ('answers_1_35' in changes or 'answers_36_45' in changes):
+        background_tasks.add_task(crud.regrade_submissions, test_id)
     return test
 
 
@@ -90,33 +181,24 @@ async def delete_test(test_id: str, db: AsyncSession = Depends(get_db)):
     return test
 
 
-@router.get("/export/{test_id}")
-async def export_test_results_endpoint(test_id: str, db: AsyncSession = Depends(get_db)):
+@analytics_router.get("/export/{test_id}")
+async def export_test_results_endpoint(
+        test_id: str,
+        format: Literal["xlsx", "csv"] = "xlsx",
+        db: AsyncSession = Depends(get_db)
+):
     """
-    Export test results as an Excel file for a given test ID.
+    Export test results as an Excel (or CSV) file for a given test ID.
+    Rows are graded and streamed in chunks, nothing is written to disk.
     """
-    tmp_path = None
     try:
-        # Call the business logic to generate the Excel file
-        excel_file, filename = await export_test_results(db, test_id)
-
-        # Create a temporary file that won't be automatically deleted
-        tmp_path = f"temp_{filename}"
-        with open(tmp_path, "wb") as tmp:
-            tmp.write(excel_file.getvalue())
-
-        # Return the file as a response
-        response = FileResponse(
-            path=tmp_path,
-            filename=filename,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        chunks, filename, media_type = await crud.open_results_export(db, test_id, format)
+        return StreamingResponse(
+            chunks,
+            media_type=media_type,
             headers={"Content-Disposition": f"attachment; filename={filename}"}
         )
 
-        response.background = BackgroundTask(lambda: os.unlink(tmp_path) if os.path.exists(tmp_path) else None)
-
-        return response
-
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -124,117 +206,35 @@ async def export_test_results_endpoint(test_id: str, db: AsyncSession = Depends(
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
-@router.get("/rasch-analysis/{test_id}")
+@analytics_router.get("/rasch-analysis/{test_id}")
 async def perform_rasch_analysis(
         test_id: str,
+        request: Request,
         db: AsyncSession = Depends(get_db)  # Inject database session
 ):
     """
     Perform Rasch analysis on test results and return Excel file with scores.
+    Results are cached per submission-set version, which is also the ETag.
     """
     try:
-        # Load data with database session
-        df = await export_df_results(db, test_id)  # Pass db session
-
-        if df is None or df.empty:
-            raise HTTPException(
-                status_code=404,
-                detail="No data found for this test ID"
-            )
-
-        print(f"Data loaded successfully with {len(df)} rows")
-        print("Faylda mavjud ustunlar:", df.columns.tolist())
-
-        # Agar ustun nomlari boshqacha bo'lsa, ularni moslashtiring
-        required_columns = ['№', 'F.I.O.', 'Duris']
-        available_columns = df.columns.tolist()
-
-        # Ustun nomlarini tekshirish va moslashtirish
-        if not all(col in available_columns for col in required_columns):
-            # Agar standart nomlar topilmasa, birinchi 3 ustundan foydalaning
-            if len(df.columns) >= 3:
-                df.columns = ['№', 'F.I.O.', 'Duris'] + list(df.columns[3:])
-                print("Ustun nomlari avtomatik moslashtirildi")
-            else:
-                raise ValueError("Faylda kamida 3 ta ustun bo'lishi kerak")
-
-        # Column handling
-        if len(df.columns) < 3:
-            raise ValueError("File must have at least 3 columns")
-
-        # Auto-detect response columns (assuming they start from column 3)
-        response_cols = df.columns[3:]
-        print(f"Detected {len(response_cols)} response columns")
-
-        # Convert responses to binary (1 for correct, 0 for incorrect)
-        response_data = df[response_cols].applymap(lambda x: 1 if x == 1 else 0)
-
-        # Fit Rasch model with progress tracking
-        print("Fitting Rasch model...")
-        model = FastRaschModel()
-        model.fit(response_data)
-
-        # Calculate scores
-        print("Calculating scores...")
-        df['Theta'] = model.person_ability
-        df['Ball'] = 50 + 10 * zscore(df['Theta'])
-        df['Ball'] = np.round(df['Ball'], 2)
-
-        df['Ball'] = df['Ball'] + np.random.uniform(-0.05, 0.05, size=len(df['Ball']))
-        df['Ball'] = df['Ball'].round(decimals=2)
-
-        # Determine subject type based on max possible score
-        max_possible = len(response_cols)
-        subject_type = "1-fan" if max_possible >= 45 else "2-fan"
-
-        # Calculate proportional scores
-        theta_min = df['Theta'].min()
-        theta_range = df['Theta'].max() - theta_min
-        if theta_range > 0:
-            df['Prop_Score'] = ((df['Theta'] - theta_min) / theta_range) * (max_possible - 65) + 65
-        else:
-            df['Prop_Score'] = 65  # Handle case where all abilities are equal
-
-        # Assign grades
-        bins = [0, 46, 50, 55, 60, 65, 70, 93]
-        labels = ['NC', 'C', 'C+', 'B', 'B+', 'A', 'A+']
-        df['Daraja'] = pd.cut(df['Ball'], bins=bins, labels=labels, right=False)
-
-        # Save results
-        result_cols = ['№', 'F.I.O.', 'Ball', 'Daraja']
-        if '№' not in df.columns:
-            result_cols = [col for col in result_cols if col != '№']
-
-        print("Saving results...")
-        result_path = f'rasch_{test_id}_natijalar.xlsx'
-
-        df = df.sort_values(by='Ball', ascending=False)
-        df['№'] = range(1, len(df) + 1)
-
-        # Create Excel file in memory
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df[result_cols].to_excel(writer, index=False, sheet_name='Natijalar')
-        output.seek(0)
-
-        filename = f"rasch_{test_id}_natijalar.xlsx"
-
-        tmp_path = f"temp_{filename}"
-        with open(tmp_path, "wb") as tmp:
-            tmp.write(output.getvalue())
-
-        # Return the file as a response
-        response = FileResponse(
-            path=tmp_path,
-            filename=filename,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        version = await crud.rasch_results_version(db, test_id)
+        if etag_matches(request.headers.get("if-none-match"), version):
+            return Response(status_code=304, headers={"ETag": version})
 
-        # Set a callback to delete the file after the response is sent
-        response.background = BackgroundTask(lambda: os.unlink(tmp_path) if os.path.exists(tmp_path) else None)
+        # Grading, fitting and rendering run in the analysis process pool
+        result = await crud.get_rasch_results(db, test_id, version)
 
-        return response
+        return Response(
+            content=result.content,
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers={
+                "Content-Disposition": f"attachment; filename={result.filename}",
+                "ETag": result.version
+            }
+        )
 
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except HTTPException:
         raise  # Re-raise HTTP exceptions
     except Exception as e:
@@ -242,3 +242,52 @@ async def perform_rasch_analysis(
             status_code=500,
             detail=f"Error processing file: {str(e)}"
         )
+
+
+@analytics_router.post("/rasch-analysis/{test_id}/jobs", status_code=202, response_model=schemas.JobResponse)
+async def start_rasch_analysis_job(test_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Start Rasch analysis in the background; poll GET /jobs/{job_id} for progress.
+    """
+    if not await crud.get_answer_key(db, test_id):
+        raise HTTPException(status_code=404, detail="Test not found")
+    return jobs.start_job("rasch-analysis", test_id, export_rasch_results)
+
+
+@analytics_router.post("/export/{test_id}/jobs", status_code=202, response_model=schemas.JobResponse)
+async def start_export_job(test_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Start a results export in the background; poll GET /jobs/{job_id} for progress.
+    """
+    if not await crud.get_answer_key(db, test_id):
+        raise HTTPException(status_code=404, detail="Test not found")
+    return jobs.start_job("export", test_id, export_test_results)
+
+
+@analytics_router.get("/jobs/{job_id}", response_model=schemas.JobResponse)
+async def get_job_status(job_id: str):
+    job = jobs.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@analytics_router.get("/jobs/{job_id}/result")
+async def download_job_result(job_id: str):
+    """
+    Download the finished file of a job. Results stay in memory, so repeated
+    downloads do not recompute anything.
+    """
+    job = jobs.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == "failed":
+        raise HTTPException(status_code=422, detail=job.error)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job is still {job.status} ({job.stage})")
+
+    return Response(
+        content=job.content,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f"attachment; filename={job.filename}"}
+    )
@@ -1,8 +1,10 @@
 import json
 from datetime import datetime
-from typing import Dict, Optional, Union
+from typing import Dict, List, Optional, Union
 from pydantic import BaseModel, ConfigDict, field_validator, Field
 
+from app.grading import MAX_MCQ_ITEMS
+
 
 # TestResponse and AnswerSubmission remain unchanged
 class TestResponse(BaseModel):
@@ -64,6 +66,17 @@ class CheckAnswersResponse(BaseModel):
     total_correct: float
     percentage: float
 
+class CheckAnswersBatchRequest(BaseModel):
+    sheets: List[CheckAnswersRequest] = Field(..., min_length=1, description="Answer sheets, for one or more tests")
+
+class CheckAnswersBatchItem(BaseModel):
+    test_id: str
+    result: Optional[CheckAnswersResponse] = None
+    error: Optional[str] = Field(default=None, description="Why the sheet could not be checked, e.g. 'Test not found'")
+
+class CheckAnswersBatchResponse(BaseModel):
+    results: List[CheckAnswersBatchItem]  # in the order of the request's sheets
+
 class MathAnswer(BaseModel):
     a: str
     b: str
@@ -82,15 +95,29 @@ class SubmitAnswersRequest(BaseModel):
 
 class TestCreate(BaseModel):
     test_id: str = Field(..., max_length=20)
-    answers_1_35: Dict[str, str]
+    # Longer keys would not fit in the stored correct_mask
+    answers_1_35: Dict[str, str] = Field(..., max_length=MAX_MCQ_ITEMS)
     answers_36_45: Dict[str, Union[str, Dict[str, str]]]
     status: str = "inactive"
     max_grade: int = 93
 
 
 class TestUpdate(BaseModel):
-    answers_1_35: Optional[Dict[str, str]] = None
+    answers_1_35: Optional[Dict[str, str]] = Field(default=None, max_length=MAX_MCQ_ITEMS)
     answers_36_45: Optional[Dict[str, Union[str, Dict[str, str]]]] = None
     status: Optional[str] = None
     max_grade: Optional[int] = None
 
+
+class JobResponse(BaseModel):
+    """Status of a background analysis or export job"""
+    id: str = Field(..., description="Job identifier")
+    kind: str = Field(..., description="Job type ('rasch-analysis' or 'export')")
+    test_id: str
+    status: str = Field(..., description="pending, running, done or failed")
+    stage: str = Field(..., description="Current step (queued, fetching, grading, fitting, rendering, finished)")
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
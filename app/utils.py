@@ -1,19 +1,668 @@
-from typing import Dict, Any
-from sympy import simplify
-from sympy.parsing.latex import parse_latex
+import cmath
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, Iterable, List, NamedTuple, Optional, Sequence, Tuple
 
+import numpy as np
 
-def is_expression_equal(user_input: str, correct_input: str) -> bool:
+from app.lru import LRUCache
+from app.metrics import comparison_duration
+
+logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Maximum number of (test, question, part, answer) verdicts kept in memory
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "100000"))
+
+_WHITESPACE = re.compile(r"\s+")
+# A space only matters between a letter and a letter (e.g. "\cdot x")
+_INSIGNIFICANT_SPACE = re.compile(r" (?![a-zA-Z])|(?<![a-zA-Z]) ")
+
+_NUMBER = re.compile(r"^[+-]?(\d+([.,]\d*)?|[.,]\d+)$")
+_FRACTION = re.compile(r"^(-)?\\d?frac\{(\d+)\}\{(\d+)\}$")
+_SLASH_FRACTION = re.compile(r"^(-)?(\d+)/(\d+)$")
+
+# Tolerances for numeric comparison and number of random evaluation points
+REL_TOLERANCE = 1e-9
+ABS_TOLERANCE = 1e-9
+SAMPLE_POINTS = 5
+
+# Sympy comparisons run in separate processes with a per-comparison time budget
+# (seconds) and an address-space cap per worker (MB, 0 disables the cap)
+SYMPY_ISOLATION = os.getenv("SYMPY_ISOLATION", "1") == "1"
+SYMPY_WORKERS = int(os.getenv("SYMPY_WORKERS", "2"))
+SYMPY_TIMEOUT = float(os.getenv("SYMPY_TIMEOUT", "5"))
+SYMPY_MEMORY_LIMIT_MB = int(os.getenv("SYMPY_MEMORY_LIMIT_MB", "1024"))
+# Distinct answers per batched sampling call; each call gets one SYMPY_TIMEOUT budget
+SYMPY_BATCH_SIZE = int(os.getenv("SYMPY_BATCH_SIZE", "64"))
+# Seconds a new worker may take to start and import sympy before it is given up on
+SYMPY_WORKER_START_TIMEOUT = 60
+
+# Guard workers are spawned: forking the threaded web process is unsafe, and a
+# forkserver's state would be inherited by the forked analysis workers
+_GUARD_CONTEXT = multiprocessing.get_context("spawn")
+# Tiers that say nothing about the answer, only that no verdict was reached; such
+# verdicts count as incorrect for now but are never cached or stored
+UNDECIDED_TIERS = ("timeout", "lost")
+
+# How many comparisons each tier (exact, numeric, sampled, symbolic, timeout, lost, memory, error) decided
+tier_counts: Counter = Counter()
+_tier_lock = threading.Lock()
+
+
+class VerdictCache(LRUCache):
+    """Bounded LRU map of normalized user answers to grading verdicts."""
+
+    def invalidate(self, test_id: str):
+        self.pop_where(lambda key: key[0] == test_id)
+
+
+verdict_cache = VerdictCache(VERDICT_CACHE_SIZE)
+
+# test_id -> (answers_36_45 the entry was built from, {(question, part): ReferenceExpression})
+_reference_cache: Dict[str, Tuple[Dict[str, Any], Dict[Tuple[str, str], Any]]] = {}
+
+
+class ReferenceExpression(NamedTuple):
+    """A reference answer prepared for every comparison tier."""
+    latex: str
+    number: Optional[float]
+    expr: Any
+
+
+def parse_number(latex: str) -> Optional[float]:
+    """Plain integers, decimals and integer fractions; None for anything else."""
+    match = _NUMBER.match(latex)
+    if match:
+        return float(latex.replace(",", "."))
+    match = _FRACTION.match(latex) or _SLASH_FRACTION.match(latex)
+    if match:
+        sign = -1.0 if match.group(1) else 1.0
+        denominator = int(match.group(3))
+        if denominator != 0:
+            return sign * int(match.group(2)) / denominator
+    return None
+
+
+def _sympy():
+    """simplify and parse_latex, importing sympy (about a second) on first use only."""
+    from sympy import simplify
+    from sympy.parsing.latex import parse_latex
+    return simplify, parse_latex
+
+
+def _parse_reference(correct_input: str, with_expr: bool = True) -> ReferenceExpression:
+    """
+    with_expr=False skips sympy: with SYMPY_ISOLATION the symbolic tiers parse
+    the reference inside the guarded pool, so the web process never needs it.
+    """
+    latex = normalize_latex(correct_input)
+    expr = None
+    if with_expr:
+        simplify, parse_latex = _sympy()
+        try:
+            expr = simplify(parse_latex(latex))
+        except Exception as e:
+            logger.warning(f"Error parsing reference expression {latex!r}: {e}")
+    return ReferenceExpression(latex, parse_number(latex), expr)
+
+
+def build_reference_expressions(test_id: str, answers_36_45: Dict[str, Any]) -> Dict[Tuple[str, str], ReferenceExpression]:
+    """Parse and simplify every reference expression of a test once and cache them."""
+    references = {}
+    for q, parts in (answers_36_45 or {}).items():
+        if not isinstance(parts, dict):
+            continue
+        for part, correct_input in parts.items():
+            if isinstance(correct_input, str):
+                references[(str(q), part)] = _parse_reference(correct_input, with_expr=not SYMPY_ISOLATION)
+
+    _reference_cache[test_id] = (answers_36_45, references)
+    verdict_cache.invalidate(test_id)
+    return references
+
+
+def get_reference_expressions(test_id: str, answers_36_45: Dict[str, Any]) -> Dict[Tuple[str, str], ReferenceExpression]:
+    """
+    Cached reference expressions for a test. The entry is rebuilt if the answer
+    key differs from the one it was built from, so worker processes that never
+    saw the invalidation cannot serve a stale key.
+    """
+    cached = _reference_cache.get(test_id)
+    if cached is not None and cached[0] == answers_36_45:
+        return cached[1]
+    return build_reference_expressions(test_id, answers_36_45)
+
+
+def invalidate_reference_expressions(test_id: str):
+    _reference_cache.pop(test_id, None)
+    verdict_cache.invalidate(test_id)
+
+
+def mcq_key(answers_1_35: Any) -> Tuple[str, ...]:
+    """
+    Multiple-choice key as a tuple in question order, whether it is stored as
+    'ABCD...' or as {'1': 'A', '2': 'B', ...}.
+    """
+    if answers_1_35 is None:
+        return ()
+    if isinstance(answers_1_35, dict):
+        return tuple(str(answers_1_35[k]) for k in sorted(answers_1_35, key=int))
+    return tuple(str(answer) for answer in answers_1_35)
+
+
+def answer_key_hash(answers_1_35: Any, answers_36_45: Any) -> str:
+    """Short fingerprint of an answer key, stored next to grades computed with it."""
+    payload = json.dumps([mcq_key(answers_1_35), answers_36_45], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def normalize_latex(latex: str) -> str:
+    """Drop whitespace that cannot change how a LaTeX answer parses."""
+    return _INSIGNIFICANT_SPACE.sub("", _WHITESPACE.sub(" ", latex.strip()))
+
+
+def _record_tier(tier: str, seconds: float = 0.0):
+    with _tier_lock:
+        tier_counts[tier] += 1
+    comparison_duration.observe(seconds, tier)
+
+
+def comparison_tier_stats() -> Dict[str, int]:
+    with _tier_lock:
+        return dict(tier_counts)
+
+
+def _numeric_value(expr, values) -> Optional[complex]:
+    try:
+        value = complex(expr.evalf(15, subs=values))
+    except Exception:
+        return None
+    if not (math.isfinite(value.real) and math.isfinite(value.imag)):
+        return None
+    return value
+
+
+def _sample_points(symbols) -> Dict[Any, List[float]]:
+    """
+    2 * SAMPLE_POINTS values per symbol: SAMPLE_POINTS positive ones, then as
+    many with random signs (the first negative). Positive points alone cannot
+    tell |x| from x or \\ln(x^2) from 2\\ln(x).
+    """
+    # Seeded by the symbol's name, so x gets the same points whichever answers
+    # it is compared or batched with
+    points = {}
+    for symbol in symbols:
+        rng = random.Random(str(symbol))
+        positive = [rng.uniform(0.5, 2.5) for _ in range(SAMPLE_POINTS)]
+        signed = [rng.uniform(0.5, 2.5) * (-1 if k == 0 or rng.random() < 0.5 else 1) for k in range(SAMPLE_POINTS)]
+        points[symbol] = positive + signed
+    return points
+
+
+def _sampled_verdict(user_expr, correct_expr) -> Optional[bool]:
+    """
+    Evaluate both expressions at the same pseudo-random points. Returns None when
+    the evaluation is inconclusive (undefined points, evaluation errors), or when
+    the expressions agree only at the positive points and need the symbolic tier.
+    """
+    symbols = sorted(user_expr.free_symbols | correct_expr.free_symbols, key=str)
+    points = _sample_points(symbols)
+    verdict = True
+    for k in range(2 * SAMPLE_POINTS if symbols else 1):
+        values = {symbol: points[symbol][k] for symbol in symbols}
+        user_value = _numeric_value(user_expr, values)
+        correct_value = _numeric_value(correct_expr, values)
+        if user_value is None or correct_value is None:
+            if k < SAMPLE_POINTS:
+                return None
+            verdict = None
+        elif not cmath.isclose(user_value, correct_value, rel_tol=REL_TOLERANCE, abs_tol=ABS_TOLERANCE):
+            if k < SAMPLE_POINTS:
+                return False
+            verdict = None
+    return verdict
+
+
+def _symbolic_compare(user_latex: str, correct_expr) -> Tuple[bool, str]:
+    """Sampled and symbolic tiers; the only part of a comparison that runs sympy."""
+    if correct_expr is None:
+        return False, "error"
+    simplify, parse_latex = _sympy()
     try:
-        user_expr = simplify(parse_latex(user_input))
-        correct_expr = simplify(parse_latex(correct_input))
-        return user_expr.equals(correct_expr)
+        user_expr = parse_latex(user_latex)
     except Exception as e:
-        print("Error in comparison:", e)
-        return False
+        logger.debug(f"Error in comparison: {e}")
+        return False, "error"
+
+    try:
+        verdict = _sampled_verdict(user_expr, correct_expr)
+        if verdict is not None:
+            return verdict, "sampled"
+
+        difference = simplify(user_expr - correct_expr)
+        return bool(difference == 0 or difference.equals(0)), "symbolic"
+    except Exception as e:
+        logger.debug(f"Error in comparison: {e}")
+        return False, "error"
+
+
+def _lambdified_values(symbols, exprs, points) -> List[Optional[np.ndarray]]:
+    """Complex values of each expression at the sample points, None where NumPy cannot evaluate it."""
+    from sympy import lambdify
+
+    def as_points(value):
+        return np.broadcast_to(np.asarray(value, dtype=complex), (2 * SAMPLE_POINTS,))
+
+    with np.errstate(all="ignore"):
+        try:
+            # One generated function evaluates every expression in a single call
+            return [as_points(value) for value in lambdify(symbols, exprs, modules="numpy")(*points)]
+        except Exception:
+            pass
+        # Some expression has no NumPy translation; it must not fail the others
+        values = []
+        for expr in exprs:
+            try:
+                values.append(as_points(lambdify(symbols, expr, modules="numpy")(*points)))
+            except Exception:
+                values.append(None)
+        return values
+
+
+def _batch_sampled_verdicts(user_latexes: Sequence[str], correct_expr) -> List[Optional[Tuple[bool, str]]]:
+    """
+    Sampled tier for many answers to one reference. The reference and every
+    answer are lambdified together and evaluated at the sample points with
+    NumPy. None marks answers the samples cannot decide, for the symbolic tier.
+    """
+    if correct_expr is None:
+        return [(False, "error")] * len(user_latexes)
+    _, parse_latex = _sympy()
+    results: List[Optional[Tuple[bool, str]]] = [None] * len(user_latexes)
+    parsed = {}
+    numbers = {}
+    for i, user_latex in enumerate(user_latexes):
+        # Plain numbers are constants at every point; the LaTeX parser costs
+        # far more than the comparison
+        number = parse_number(user_latex)
+        if number is not None:
+            numbers[i] = number
+            continue
+        try:
+            parsed[i] = parse_latex(user_latex)
+        except Exception as e:
+            logger.debug(f"Error in comparison: {e}")
+            results[i] = (False, "error")
+    if not parsed and not numbers:
+        return results
+
+    exprs = [correct_expr] + list(parsed.values())
+    symbols = sorted(set().union(*(expr.free_symbols for expr in exprs)), key=str)
+    points = _sample_points(symbols)
+    values = _lambdified_values(symbols, exprs, [np.array(points[symbol], dtype=complex) for symbol in symbols])
+    correct_values = values[0]
+    if correct_values is None or not np.isfinite(correct_values[:SAMPLE_POINTS]).all():
+        return results
+
+    user_values_by_index = dict(zip(parsed, values[1:]))
+    user_values_by_index.update((i, np.full(2 * SAMPLE_POINTS, number, dtype=complex)) for i, number in numbers.items())
+    for i, user_values in user_values_by_index.items():
+        if user_values is None or not np.isfinite(user_values[:SAMPLE_POINTS]).all():
+            continue
+        # cmath.isclose, one sample point per element; undefined points never match
+        tolerance = np.maximum(REL_TOLERANCE * np.maximum(abs(user_values), abs(correct_values)), ABS_TOLERANCE)
+        close = abs(user_values - correct_values) <= tolerance
+        if not close[:SAMPLE_POINTS].all():
+            results[i] = False, "sampled"
+        elif close.all():
+            results[i] = True, "sampled"
+        # Equal only at the positive points: left to the symbolic tier
+    return results
+
+
+@lru_cache(maxsize=1024)
+def _worker_reference(reference_latex: str):
+    return _parse_reference(reference_latex).expr
+
+
+def _mapped_memory() -> int:
+    """Address space already mapped by this process in bytes, 0 where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _init_sympy_worker():
+    # Import sympy and load the LaTeX parser and lambdify once, before the memory
+    # cap and outside any comparison budget
+    _, parse_latex = _sympy()
+    _batch_sampled_verdicts(["x+1"], parse_latex("1+x"))
+    _limit_worker_memory()
+
+
+def _limit_worker_memory():
+    if resource is not None and SYMPY_MEMORY_LIMIT_MB > 0:
+        # Forked workers inherit the parent's mappings (numba, thread stacks, the
+        # event loop), so the cap is headroom on top of those, not an absolute size
+        limit = _mapped_memory() + SYMPY_MEMORY_LIMIT_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _guarded_compare(user_latex: str, reference_latex: str) -> Tuple[bool, str]:
+    try:
+        return _symbolic_compare(user_latex, _worker_reference(reference_latex))
+    except MemoryError:
+        return False, "memory"
+
+
+def _guarded_sampled_batch(user_latexes: Sequence[str], reference_latex: str) -> List[Optional[Tuple[bool, str]]]:
+    try:
+        return _batch_sampled_verdicts(user_latexes, _worker_reference(reference_latex))
+    except MemoryError:
+        return [None] * len(user_latexes)
+
+
+def _sympy_worker_main(conn):
+    """Guard worker: runs one (function, args) at a time and sends back (ok, result)."""
+    _init_sympy_worker()
+    conn.send((True, None))  # ready; the first task's budget starts after this
+    parent = multiprocessing.parent_process()
+    while True:
+        # Leave with the parent even if it was killed without closing the pipe
+        while not conn.poll(1.0):
+            if parent is not None and not parent.is_alive():
+                return
+        try:
+            function, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send((True, function(*args)))
+        except Exception as e:
+            conn.send((False, repr(e)))
+
+
+class _GuardWorker:
+    """One guard process and the parent's end of its pipe."""
+
+    def __init__(self):
+        self.conn, child_conn = _GUARD_CONTEXT.Pipe()
+        self.process = _GUARD_CONTEXT.Process(target=_sympy_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=1)
+        self.conn.close()
+
+
+class SympyGuard:
+    """
+    Runs sympy comparisons in a few dedicated worker processes with a wall-clock
+    budget per call and a memory cap per worker. The budget starts when a worker
+    receives the call, so waiting for a free worker, starting one and importing
+    sympy are not counted. A call that overruns counts as incorrect and only the
+    worker running it is killed and replaced; other callers are unaffected.
+    """
+
+    def __init__(self, workers: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle: Optional[queue.Queue] = None  # started workers waiting for a call
+        self._all: set = set()
+
+    def _idle_workers(self) -> queue.Queue:
+        with self._lock:
+            if self._idle is None:
+                self._idle = queue.Queue()
+                for _ in range(self.workers):
+                    self._start_worker()
+            return self._idle
+
+    def _start_worker(self):
+        worker = _GuardWorker()
+        self._all.add(worker)
+        self._idle.put(worker)
+
+    def _replace(self, worker: _GuardWorker, idle: queue.Queue):
+        worker.kill()
+        with self._lock:
+            self._all.discard(worker)
+            if self._idle is idle:  # not shut down meanwhile
+                self._start_worker()
+
+    def _run(self, function, *args) -> Tuple[str, Any]:
+        """function(*args) on a free worker: ("ok", result), ("timeout"|"lost"|"failed", detail)."""
+        idle = self._idle_workers()
+        while True:
+            try:
+                worker = idle.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if self._idle is not idle:
+                    return "lost", "guard shut down"
+        try:
+            if not worker.ready:
+                if not worker.conn.poll(SYMPY_WORKER_START_TIMEOUT):
+                    self._replace(worker, idle)
+                    return "lost", "worker did not start"
+                worker.conn.recv()
+                worker.ready = True
+            worker.conn.send((function, args))
+            if not worker.conn.poll(self.timeout):
+                self._replace(worker, idle)
+                return "timeout", None
+            ok, result = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            # The worker died mid-call (crash, kill, shutdown)
+            self._replace(worker, idle)
+            return "lost", repr(e)
+        idle.put(worker)
+        return ("ok", result) if ok else ("failed", result)
+
+    def evaluate(self, user_latex: str, reference_latex: str) -> Tuple[bool, str]:
+        # One retry covers a worker that died under this call for reasons of its own
+        for _ in range(2):
+            status, result = self._run(_guarded_compare, user_latex, reference_latex)
+            if status == "ok":
+                return result
+            if status == "timeout":
+                logger.warning(f"Comparison timed out after {self.timeout}s: {user_latex[:100]!r}")
+                return False, "timeout"
+            if status == "failed":
+                logger.debug(f"Error in comparison: {result}")
+                return False, "error"
+        logger.warning(f"Comparison lost its worker: {result}")
+        return False, "lost"
+
+    def evaluate_batch(self, user_latexes: Sequence[str], reference_latex: str) -> List[Optional[Tuple[bool, str]]]:
+        """
+        Sampled tier for many answers, SYMPY_BATCH_SIZE per worker call, chunks
+        spread over the workers. A chunk that overruns its budget or fails leaves
+        its answers undecided, so they fall back to one guarded comparison each.
+        """
+        def run_chunk(chunk: Sequence[str]) -> List[Optional[Tuple[bool, str]]]:
+            for _ in range(2):
+                status, result = self._run(_guarded_sampled_batch, chunk, reference_latex)
+                if status == "ok":
+                    return result
+                if status == "timeout":
+                    logger.warning(
+                        f"Batch comparison timed out after {self.timeout}s against {reference_latex[:100]!r}"
+                    )
+                    break
+                if status == "failed":
+                    break
+            return [None] * len(chunk)
+
+        chunks = [user_latexes[i:i + SYMPY_BATCH_SIZE] for i in range(0, len(user_latexes), SYMPY_BATCH_SIZE)]
+        if len(chunks) == 1:
+            return run_chunk(chunks[0])
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(chunks))) as dispatch:
+            return [result for results in dispatch.map(run_chunk, chunks) for result in results]
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._all, self._idle = self._all, set(), None
+        for worker in workers:
+            worker.kill()
+
+    def _forget_after_fork(self):
+        # A forked child (an analysis worker) must not use or kill the parent's
+        # workers; it starts its own on first use, and they exit with it
+        self._lock = threading.Lock()
+        self._idle = None
+        self._all = set()
+
+
+sympy_guard = SympyGuard(SYMPY_WORKERS, SYMPY_TIMEOUT)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=sympy_guard._forget_after_fork)
+
+
+def compare_expressions(user_input: str, reference: ReferenceExpression) -> Tuple[bool, str]:
+    """
+    Tiered comparison of a user answer with a reference, cheapest tier first:
+    exact normalized string, plain numbers with a tolerance, numeric evaluation
+    at sample points, and finally symbolic simplification. The last two run in
+    the guarded sympy pool unless SYMPY_ISOLATION is off.
+    Returns (verdict, name of the tier that decided it).
+    """
+    user_latex = normalize_latex(user_input)
+    return _cheap_compare(user_latex, reference) or _sympy_compare(user_latex, reference)
+
+
+def _cheap_compare(user_latex: str, reference: ReferenceExpression) -> Optional[Tuple[bool, str]]:
+    """Exact and numeric tiers; None when neither applies."""
+    if user_latex == reference.latex:
+        return True, "exact"
+
+    user_number = parse_number(user_latex)
+    if user_number is not None and reference.number is not None:
+        return math.isclose(user_number, reference.number, rel_tol=REL_TOLERANCE, abs_tol=ABS_TOLERANCE), "numeric"
+    return None
+
+
+def _sympy_compare(user_latex: str, reference: ReferenceExpression) -> Tuple[bool, str]:
+    if SYMPY_ISOLATION:
+        return sympy_guard.evaluate(user_latex, reference.latex)
+    return _symbolic_compare(user_latex, reference.expr)
+
+
+def is_expression_equal(user_input: str, correct_input: str) -> bool:
+    start = time.perf_counter()
+    reference = _parse_reference(correct_input, with_expr=not SYMPY_ISOLATION)
+    verdict, tier = compare_expressions(user_input, reference)
+    _record_tier(tier, time.perf_counter() - start)
+    return verdict
+
+
+def is_reference_equal(test_id: str, answers_36_45: Dict[str, Any], question: str, part: str, user_input: str) -> bool:
+    """
+    Compare a user answer against the cached reference expression of a test.
+    Verdicts are memoized per (test_id, question, part, normalized answer).
+    """
+    return bool(grade_reference_batch(test_id, answers_36_45, question, part, [user_input])[user_input])
+
+
+def grade_reference_batch(
+        test_id: str,
+        answers_36_45: Dict[str, Any],
+        question: str,
+        part: str,
+        user_inputs: Iterable[str]
+) -> Dict[str, Optional[bool]]:
+    """
+    Verdicts for many answers to one question part, e.g. a whole results
+    column. Each distinct normalized answer is compared once: memoized verdicts
+    first, then the exact and numeric tiers, then one batched sampled pass for
+    everything left. Only answers the samples cannot decide get a symbolic
+    comparison of their own. None marks an answer left undecided by a timeout
+    or a lost worker: it counts as incorrect but is not cached, so callers
+    must not store it either.
+    """
+    references = get_reference_expressions(test_id, answers_36_45)
+    reference = references.get((question, part))
+    # The reference is part of the key, so a batch still grading against an
+    # edited key cannot leave its verdicts to be served for the new one
+    cache_key = (test_id, question, part, reference.latex if reference is not None else None)
+    normalized = {user_input: normalize_latex(user_input) for user_input in user_inputs}
+
+    verdicts: Dict[str, Optional[bool]] = {}
+    sampled = []
+    for user_latex in dict.fromkeys(normalized.values()):
+        verdict = verdict_cache.get(cache_key + (user_latex,))
+        if verdict is not None:
+            verdicts[user_latex] = verdict
+            continue
+        start = time.perf_counter()
+        result = (False, "error") if reference is None else _cheap_compare(user_latex, reference)
+        if result is None:
+            sampled.append(user_latex)
+            continue
+        verdicts[user_latex] = result[0]
+        _record_tier(result[1], time.perf_counter() - start)
+
+    if sampled:
+        start = time.perf_counter()
+        if SYMPY_ISOLATION:
+            results = sympy_guard.evaluate_batch(sampled, reference.latex)
+        else:
+            results = _batch_sampled_verdicts(sampled, reference.expr)
+        per_answer = (time.perf_counter() - start) / len(sampled)
+        for user_latex, result in zip(sampled, results):
+            start = time.perf_counter()
+            if result is None:
+                result = _sympy_compare(user_latex, reference)
+            verdicts[user_latex] = None if result[1] in UNDECIDED_TIERS else result[0]
+            _record_tier(result[1], per_answer + time.perf_counter() - start)
+
+    for user_latex, verdict in verdicts.items():
+        if verdict is not None:
+            verdict_cache.put(cache_key + (user_latex,), verdict)
+    return {user_input: verdicts[user_latex] for user_input, user_latex in normalized.items()}
+
+
+def sheet_error(answers_1_35: Dict[str, str], correct_data) -> Optional[str]:
+    """Why an answer sheet cannot be checked against a test's key, or None."""
+    n_items = len(correct_data.answers_1_35)
+    unknown = [q for q in answers_1_35 if not (q.isdigit() and 1 <= int(q) <= n_items)]
+    if unknown:
+        return f"Unknown multiple-choice question numbers: {', '.join(unknown[:10])}"
+    return None
 
 
-def check_answers(user_data: Dict[str, Any], correct_data: Dict[str, Any]) -> Dict[str, Any]:
+def check_answers(
+        user_data: Dict[str, Any],
+        correct_data: Dict[str, Any],
+        verdicts: Optional[Dict[Tuple[str, str], Dict[str, bool]]] = None
+) -> Dict[str, Any]:
+    """
+    Per-question results of one answer sheet. `verdicts` holds free-response
+    verdicts already computed by grade_reference_batch, by (question, part).
+    """
     answers_1_35 = user_data['answers_1_35']
     answers_36_45 = user_data['answers_36_45']
     test = correct_data
@@ -45,7 +694,10 @@ def check_answers(user_data: Dict[str, Any], correct_data: Dict[str, Any]) -> Di
             if correct_input is None:
                 continue
 
-            is_correct = is_expression_equal(user_input, correct_input)
+            if verdicts is not None:
+                is_correct = bool(verdicts[(q, part)][user_input])
+            else:
+                is_correct = is_reference_equal(test.test_id, test.answers_36_45, q, part, user_input)
             if is_correct:
                 total_correct += 0.5
 
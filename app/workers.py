@@ -0,0 +1,67 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# Number of worker processes for CPU-bound grading, fitting and rendering
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "2"))
+# Compile the Rasch kernels in every worker at startup rather than on the first request
+RASCH_WARMUP = os.getenv("RASCH_WARMUP", "1") == "1"
+
+_executor = None
+_slots = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS)
+    return _executor
+
+
+async def run_cpu_bound(fn, *args, **kwargs):
+    """
+    Run a picklable function in the analysis process pool without blocking
+    the event loop. At most ANALYSIS_WORKERS calls run at once; the rest wait.
+    """
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(ANALYSIS_WORKERS)
+
+    async with _slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), partial(fn, *args, **kwargs))
+
+
+def _call_analysis(name: str, *args, **kwargs):
+    # Runs in a worker, so pandas, scipy and numba are imported there and never
+    # in the web process
+    from app import analysis
+    return getattr(analysis, name)(*args, **kwargs)
+
+
+async def run_analysis(name: str, *args, **kwargs):
+    """run_cpu_bound for a function of app.analysis, given by name."""
+    return await run_cpu_bound(_call_analysis, name, *args, **kwargs)
+
+
+def _warm_up_worker():
+    from FastRaschModel import warm_up as warm_up_rasch
+    warm_up_rasch()
+
+
+def warm_up():
+    """
+    Start every analysis worker and compile the Rasch kernels in it. Does not
+    wait: requests arriving meanwhile simply queue behind the warm-up.
+    """
+    executor = get_executor()
+    for _ in range(ANALYSIS_WORKERS):
+        executor.submit(_warm_up_worker)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
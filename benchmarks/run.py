@@ -0,0 +1,305 @@
+"""
+Benchmark harness for grading, Rasch fitting and export.
+
+    python -m benchmarks.run --sizes 1000,10000 --output bench.json
+
+Every stage runs on a synthetic cohort generated from a fixed seed, so numbers
+from two commits are comparable. The endpoint stage drives the real FastAPI app
+and needs DATABASE_URL to point at a disposable Postgres (a local server or an
+embedded one such as pgserver); it is skipped when DATABASE_URL is not set.
+SQLite is not an option: submissions use JSONB and INSERT ... ON CONFLICT.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Free-response keys with equivalent and wrong forms as students write them
+FREE_RESPONSE_TEMPLATES = [
+    ("\\frac{3}{4}", ["0.75", "\\frac{6}{8}", "3/4"], ["\\frac{4}{3}", "0.7", "1"]),
+    ("2x+1", ["1+2x", "x+x+1", "2 x + 1"], ["2x-1", "x+1", "2x"]),
+    ("\\sqrt{2}", ["2^{1/2}", "\\sqrt{ 2 }", "1.4142135623730951"], ["2", "\\sqrt{3}", "1.41"]),
+    ("x^2-1", ["(x-1)(x+1)", "x^{2}-1", "-1+x^2"], ["x^2+1", "(x-1)^2", "x^2"]),
+    ("12", ["12.0", "\\frac{24}{2}", " 12 "], ["13", "-12", "21"]),
+]
+N_MCQ = 35
+CHOICES = np.array(list("ABCD"))
+
+results = []
+
+
+def rss_mb() -> dict:
+    """Current and peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    current = None
+    try:
+        with open("/proc/self/statm") as statm:
+            current = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        pass
+    return {"rss_mb": current and round(current, 1), "peak_rss_mb": round(peak, 1)}
+
+
+@contextmanager
+def stage(name: str, size: int, items: int = None):
+    """Time a block and record it; `items` turns the timing into a throughput."""
+    entry = {"stage": name, "size": size}
+    start = time.perf_counter()
+    yield entry
+    seconds = time.perf_counter() - start
+    entry.update(seconds=round(seconds, 4), **rss_mb())
+    if items:
+        entry["per_second"] = round(items / seconds, 1)
+    results.append(entry)
+    print(f"{name:<28} n={size:<7} {seconds:9.3f}s  peak {entry['peak_rss_mb']} MB", file=sys.stderr)
+
+
+def make_key(rng: np.random.Generator):
+    mcq = "".join(rng.choice(CHOICES, N_MCQ))
+    free_response = {}
+    for q in range(36, 46):
+        a, b = rng.choice(len(FREE_RESPONSE_TEMPLATES), 2)
+        free_response[str(q)] = {"a": FREE_RESPONSE_TEMPLATES[a][0], "b": FREE_RESPONSE_TEMPLATES[b][0]}
+    return mcq, free_response
+
+
+def _free_response_answer(rng: np.random.Generator, key: str, p_correct: float) -> str:
+    template = next(t for t in FREE_RESPONSE_TEMPLATES if t[0] == key)
+    roll = rng.random()
+    if roll < 0.12:
+        return ""
+    if roll < 0.12 + p_correct * 0.7:
+        return key
+    if roll < 0.12 + p_correct:
+        return str(rng.choice(template[1]))
+    if rng.random() < 0.3:
+        return str(rng.integers(0, 200))  # long tail of distinct wrong answers
+    return str(rng.choice(template[2]))
+
+
+def make_cohort(size: int, seed: int = 0):
+    """
+    Synthetic cohort: MCQ answers drawn from a Rasch model with normal
+    abilities, free-response answers mixing exact, equivalent and wrong forms.
+    """
+    rng = np.random.default_rng(seed)
+    mcq_key, free_response_key = make_key(rng)
+    key_codes = np.array([ord(c) for c in mcq_key])
+
+    theta = rng.normal(size=size)
+    beta = rng.normal(size=N_MCQ)
+    p_correct = 1.0 / (1.0 + np.exp(-(theta[:, None] - beta[None, :])))
+    correct = rng.random((size, N_MCQ)) < p_correct
+    wrong = rng.choice(np.array([ord(c) for c in "ABCD"]), (size, N_MCQ))
+    wrong = np.where(wrong == key_codes, (wrong - 65 + 1) % 4 + 65, wrong)
+    codes = np.where(correct, key_codes, wrong)
+
+    records = []
+    for i in range(size):
+        person_p = float(1.0 / (1.0 + np.exp(-theta[i])))
+        records.append({
+            "id": i + 1,
+            "telegram_id": i + 1,
+            "firstname": f"Ism{i}",
+            "secondname": f"Familiya{i}",
+            "thirdname": "",
+            "region": str(rng.choice(["Toshkent", "Samarqand", "Buxoro", "Farg'ona"])),
+            "answers_1_35": codes[i].astype(np.uint8).tobytes().decode("ascii"),
+            "answers_36_45": {
+                q: {part: _free_response_answer(rng, parts[part], person_p) for part in ("a", "b")}
+                for q, parts in free_response_key.items()
+            },
+        })
+    return mcq_key, free_response_key, records
+
+
+def bench_import():
+    """Cold import of the web app in a fresh interpreter: what every server worker pays on start."""
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/bench")  # the engine only connects on first use
+    with stage("import_app", 0) as entry:
+        subprocess.run([sys.executable, "-c", "import app.main"], env=env, check=True)
+    entry["child_peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+
+
+def bench_in_process(size: int, records, mcq_key, free_response_key, modes, joint_max):
+    from FastRaschModel import FastRaschModel
+    from app import analysis, exports, grading, utils
+
+    test_id = f"bench-{size}"
+    with stage("expression_compare", size) as entry:
+        pairs = {(answer, free_response_key[q][part])
+                 for record in records[:200]
+                 for q, parts in record["answers_36_45"].items()
+                 for part, answer in parts.items() if answer.strip()}
+        for answer, reference in pairs:
+            utils.is_expression_equal(answer, reference)
+        entry["pairs"] = len(pairs)
+
+    utils.invalidate_reference_expressions(test_id)
+    with stage("grading", size, items=size):
+        graded = grading.grade_responses(records, mcq_key, free_response_key, test_id)
+
+    stored = [dict(record, correct_mask=mask, key_hash=graded.key_hash)
+              for record, mask in zip(records, graded.masks())]
+    with stage("results_frame", size, items=size):
+        df = analysis.build_results_frame(stored, mcq_key, free_response_key, test_id)
+
+    with stage("xlsx_render", size, items=size) as entry:
+        writer = exports.ResultsXlsxWriter(graded.columns)
+        writer.header()
+        writer.write_rows(records, graded.responses, 1)
+        entry["bytes"] = len(writer.close())
+
+    for mode in modes:
+        if mode == "joint" and size > joint_max:
+            results.append({"stage": f"rasch_fit_{mode}", "size": size, "skipped": f"size > --joint-max {joint_max}"})
+            continue
+        with stage(f"rasch_fit_{mode}", size, items=size):
+            FastRaschModel().fit(graded.matrix, method=mode)
+
+    with stage("rasch_pipeline", size, items=size):
+        analysis.run_rasch_analysis(df)
+
+
+def bench_endpoints(client, size: int, records, mcq_key, free_response_key, requests: int):
+    from sqlalchemy import delete
+
+    from app import crud, grading, models
+    from app.database import engine
+
+    test_id = f"bench-{size}"
+    test_payload = {
+        "test_id": test_id,
+        "answers_1_35": {str(i + 1): c for i, c in enumerate(mcq_key)},
+        "answers_36_45": free_response_key,
+    }
+    graded = grading.grade_responses(records, mcq_key, free_response_key, test_id)
+    rows = [
+        crud.submission_row(test_id, dict(
+            record, submission_time=datetime(2026, 1, 1), correct_mask=mask,
+            total_score=float(score), key_hash=graded.key_hash
+        ))
+        for record, mask, score in zip(records, graded.masks(), graded.scores)
+    ]
+
+    async def clear():
+        async with engine.begin() as conn:
+            await conn.execute(delete(models.Submission).where(models.Submission.test_id == test_id))
+
+    client.portal.call(clear)
+    if client.get(f"/tests/{test_id}").status_code == 200:
+        client.delete(f"/delete-test/{test_id}")
+    client.post("/insert-test", json=test_payload).raise_for_status()
+
+    async def load():
+        async with engine.begin() as conn:
+            for start in range(0, len(rows), 2000):  # 12 parameters a row, asyncpg allows 32767
+                await conn.execute(crud.insert_submissions_statement(rows[start:start + 2000]))
+
+    with stage("db_bulk_load", size, items=size):
+        client.portal.call(load)
+
+    for fmt in ("xlsx", "csv"):
+        with stage(f"GET /export ({fmt})", size, items=size) as entry:
+            with client.stream("GET", f"/export/{test_id}?format={fmt}") as response:
+                entry["bytes"] = sum(len(chunk) for chunk in response.iter_bytes())
+                entry["status"] = response.status_code
+
+    with stage("GET /rasch-analysis (cold)", size, items=size) as entry:
+        response = client.get(f"/rasch-analysis/{test_id}")
+        entry["status"] = response.status_code
+    with stage("GET /rasch-analysis (cached)", size) as entry:
+        entry["status"] = client.get(f"/rasch-analysis/{test_id}").status_code
+
+    check_payload = {
+        "test_id": test_id,
+        "answers_1_35": {str(i + 1): c for i, c in enumerate(records[0]["answers_1_35"])},
+        "answers_36_45": records[0]["answers_36_45"],
+    }
+    with stage("POST /check-answers", size, items=requests):
+        for _ in range(requests):
+            client.post("/check-answers", json=check_payload).raise_for_status()
+
+    with stage("POST /submit-answers", size, items=requests):
+        for i, record in enumerate(records[:requests]):
+            payload = {key: record[key] for key in (
+                "firstname", "secondname", "thirdname", "region", "answers_1_35", "answers_36_45")}
+            payload.update(test_id=test_id, telegram_id=size + i + 1, submission_time="2026-01-01T00:00:00")
+            client.post("/submit-answers", json=payload).raise_for_status()
+
+    client.portal.call(clear)
+    if client.get(f"/tests/{test_id}").status_code == 200:
+        client.delete(f"/delete-test/{test_id}")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated cohort sizes")
+    parser.add_argument("--modes", default="cml,collapsed,joint", help="Rasch estimation methods to time")
+    parser.add_argument("--joint-max", type=int, default=10000, help="skip joint fits above this many examinees")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint throughput stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-endpoints", action="store_true", help="skip the FastAPI/Postgres stage")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    modes = [mode for mode in args.modes.split(",") if mode]
+    run_endpoints = not args.no_endpoints and os.getenv("DATABASE_URL")
+    if not run_endpoints:
+        print("Endpoint stage skipped (set DATABASE_URL to a disposable Postgres to enable it)", file=sys.stderr)
+
+    bench_import()
+    with ExitStack() as stack:
+        client = None
+        if run_endpoints:
+            from fastapi.testclient import TestClient
+            from app.main import app
+            # One client for every size: the engine's pool is bound to its event loop
+            client = stack.enter_context(TestClient(app))
+
+        for size in sizes:
+            with stage("generate_cohort", size, items=size):
+                mcq_key, free_response_key, records = make_cohort(size, args.seed)
+            bench_in_process(size, records, mcq_key, free_response_key, modes, args.joint_max)
+            if client is not None:
+                bench_endpoints(client, size, records, mcq_key, free_response_key, min(args.requests, size))
+
+    from app.utils import sympy_guard
+    sympy_guard.shutdown()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()